@@ -4,11 +4,23 @@
 from tkinter.messagebox import showerror
 from tkinter.simpledialog import askfloat
 from tkinter import *
-from frysky_parser import FrySkyParserThread
+from frysky_chart import StripChart, CHART_HEIGHT, CHART_PAR_NAMES, CHART_UPDATE_PER
+from frysky_history import TelemetryHistory
+from frysky_link import Link, LinkPool, MAX_LINKS
+from frysky_parser import FrySkyParserThread, PacketClock, SERIAL_READ_TIMEOUT
+from frysky_process import FrySkyParserProcess, RUNNING, RECORD_FAILED
+from frysky_replay import FrySkyReplayThread, FrySkyRecordReplayThread, REPLAY_SPEEDS
+from frysky_record import FrySkyRecorder, RECORD_FILE_EXT, is_record_file
+from frysky_map import MapCatalog, MapSheet, load_map_catalog
+from frysky_track import TrackRenderer
+from frysky_metrics import MetricsRegistry, MetricsSnapshotWriter, serve_metrics
+from itertools import islice
+from math import floor, log2
 import os.path
+import time
 import json
 import serial
-from PIL import Image
+from PIL import ImageTk
 from tkinter import filedialog
 
 MAIN_WINDOW_TITLE = 'FrySky View Panel'
@@ -20,10 +32,13 @@ CANVAS_MARGIN_PX = 50
 SETTINGS_BUTTON_PROMPT = 'ctrl + \'S\': COM settings'
 OPEN_DUMP_FILE_PROMPT = 'ctrl + \'D\': open dump file'
 STOP_PARSING_PROMPT = 'ctrl + \'C\': stop parsing'
+ADD_LINK_PROMPT = 'ctrl + \'S\' / \'D\': add link'
+REPLAY_PROMPT = 'space: pause, +/-: speed, ctrl + \'G\': go to'
 
 STD_BAUDRATES_TABLE = ['9600', '19200', '38400', '115200']
 
 CELL_CAPTION_WIDTH = 18
+CELL_VALUE_WIDTH = 9
 
 SETTINGS_FILE = 'settings.json'
 MAP_FILE = 'map.png'
@@ -34,16 +49,49 @@ MAP_LAT_MIN = 50.21002 - 0.01
 MAP_LAT_MAX = 50.2458 + 0.01
 MAP_WIDTH = 0.05578
 
+ZOOM_STEPS_PER_OCTAVE = 4  # Map scales are rounded down to these steps so scaled tiles can be reused
+
+UI_FRAME_RATE = 15  # UI updates per second
+UI_TICK_BUDGET = 0.03  # Time of one UI update after which the rest of new data waits for the next one, seconds
+UI_COOR_BATCH = 256  # Coordinates taken into the track at once
+STATUS_UPDATE_PER = 0.5  # Period of the status panel update, seconds
+
+
+# Catalog of the single map the panel had before catalogs: its height in degrees follows
+# the image aspect
+def default_map_catalog():
+    catalog = MapCatalog()
+    sheet = MapSheet(MAP_FILE, None)
+    sheet.bounds = (MAP_LONG_MIN, MAP_LAT_MIN,
+                    MAP_LONG_MIN + MAP_WIDTH, MAP_LAT_MIN + MAP_WIDTH * sheet.size[1] / sheet.size[0])
+    catalog.add(sheet)
+    return catalog
+
 
 class Gui(Tk):
     cells = (
-        {'caption': 'Signal level',    'name': 'sig_lev',  'cell': None},
-        {'caption': 'Current, A',      'name': 'cur',      'cell': None},
-        {'caption': 'Voltage, V',      'name': 'vlt',      'cell': None},
-        {'caption': 'Rot. freq., RPM', 'name': 'rot_freq', 'cell': None}
+        {'caption': 'Signal level',    'name': 'sig_lev'},
+        {'caption': 'Current, A',      'name': 'cur'},
+        {'caption': 'Voltage, V',      'name': 'vlt'},
+        {'caption': 'Rot. freq., RPM', 'name': 'rot_freq'},
+        # derived from the decoded parameters as they arrive, see frysky_derived
+        {'caption': 'Capacity, mAh',   'name': 'cap'},
+        {'caption': 'Min. voltage, V', 'name': 'vlt_min'},
+        {'caption': 'Mean current, A', 'name': 'cur_mean'},
+        {'caption': 'Max. current, A', 'name': 'cur_max'},
+        {'caption': 'Distance, m',     'name': 'dist'},
+        {'caption': 'Speed, km/h',     'name': 'gnd_speed'}
     )
 
-    coor = []
+    status_cells = (
+        {'caption': 'Bytes',            'name': 'parser.bytes'},
+        {'caption': 'Frames',           'name': 'parser.frames'},
+        {'caption': 'Dropped frames',   'name': 'parser.dropped_frames'},
+        {'caption': 'Buffered values',  'name': 'params.depth'},
+        {'caption': 'Decode p99, ms',   'name': 'parser.decode_time'},
+        {'caption': 'Poll lag p99, ms', 'name': 'link.poll_lag'},
+        {'caption': 'UI tick p99, ms',  'name': 'ui.tick_time'}
+    )
 
     px_per_deg = 100.0 * 1000.0  # 100 pixels per 0.001 minute of angle (1.85 m)
 
@@ -66,68 +114,168 @@ class Gui(Tk):
 
         self.top_prompt = Label(inpan, text=SETTINGS_BUTTON_PROMPT, anchor='s')
         self.btm_prompt = Label(inpan, text=OPEN_DUMP_FILE_PROMPT, anchor='s')
+        self.link_prompt = Label(inpan, text='', anchor='s')
         self.top_prompt.grid(row=1, column=0, sticky='S')
         self.btm_prompt.grid(row=2, column=0, sticky='S')
+        self.link_prompt.grid(row=3, column=0, sticky='S')
 
         self.can = Canvas(self, width=MAIN_WINDOW_WIDTH * 2 // 3, height=MAIN_WINDOW_HEIGHT,
                           background='#ffffff')
         self.can.grid(row=0, column=1, columnspan=2)
-        self.can_base = (MAIN_WINDOW_WIDTH // 3, MAIN_WINDOW_HEIGHT // 2)  # canvas center
-
-        genpan = Frame(self, width=MAIN_WINDOW_WIDTH // 3)
-        genpan.grid(row=0, column=0, sticky='ewn')
-
-        genpan_cap = Label(genpan, text='General info', bg='#cccccc')
-        genpan_cap.grid(row=0, column=0, sticky='ew', columnspan=2)
 
+        # Strip charts of all links, one under another, see update_charts(). The parameters
+        # charted are set in the settings
+        chart_par_names = self.settings.get('charts', CHART_PAR_NAMES)
+        self.charts_height = CHART_HEIGHT * len(chart_par_names)
+        captions = {cell['name']: cell['caption'] for cell in self.cells}
+        self.charts = []
+        if chart_par_names:
+            self.charts_can = Canvas(self, width=MAIN_WINDOW_WIDTH, height=self.charts_height,
+                                     background='#ffffff', highlightthickness=0)
+            self.charts_can.grid(row=1, column=0, columnspan=3, sticky='w')
+            for chart_no, par_name in enumerate(chart_par_names):
+                self.charts.append((par_name, StripChart(self.charts_can, 0, chart_no * CHART_HEIGHT,
+                                                         MAIN_WINDOW_WIDTH, CHART_HEIGHT,
+                                                         captions.get(par_name, par_name),
+                                                         'chart{}'.format(chart_no + 1))))
+
+        # Captions only, every link adds a column of cells, see show_link()
+        self.genpan = Frame(self, width=MAIN_WINDOW_WIDTH // 3)
+        self.genpan.grid(row=0, column=0, sticky='ewn')
+
+        self.genpan_cap = Label(self.genpan, text='General info', bg='#cccccc')
+        self.genpan_cap.grid(row=0, column=0, sticky='ew', columnspan=2)
+
+        self.cell_rows = {}
         row_cntr = 2
         for cell in self.cells:
-            cap = Label(genpan, text=cell['caption'], width=CELL_CAPTION_WIDTH)
+            cap = Label(self.genpan, text=cell['caption'], width=CELL_CAPTION_WIDTH)
+            cap.grid(row=row_cntr, column=0)
+            self.cell_rows[cell['name']] = row_cntr
+            row_cntr += 1
+
+        self.status_cap = Label(self.genpan, text='Status', bg='#cccccc')
+        self.status_cap.grid(row=row_cntr, column=0, sticky='ew', columnspan=2)
+        row_cntr += 1
+        self.status_cell_rows = {}
+        for cell in self.status_cells:
+            cap = Label(self.genpan, text=cell['caption'], width=CELL_CAPTION_WIDTH)
             cap.grid(row=row_cntr, column=0)
-            cell['cell'] = Label(genpan, text='n/d', width=CELL_CAPTION_WIDTH, anchor='w',
-                                 bg='#eeeeee')
-            cell['cell'].grid(row=row_cntr, column=1)
+            self.status_cell_rows[cell['name']] = row_cntr
             row_cntr += 1
 
-        self.img = Image.open(MAP_FILE)
+        self.metrics = MetricsRegistry()
+        self.ui_tick_time = self.metrics.histogram('ui.tick_time')
+        # snapshots of the metrics are written to the file and served on localhost if these are set
+        if self.settings.get('metrics_file'):
+            MetricsSnapshotWriter(self.metrics, self.settings['metrics_file']).start()
+        if self.settings.get('metrics_port'):
+            serve_metrics(self.metrics, self.settings['metrics_port'])
+
+        # sheets with bounds in the catalog directory, see frysky_map, else MAP_FILE is the only sheet
+        if self.settings.get('map_dir'):
+            self.map_catalog = load_map_catalog(self.settings['map_dir'])
+        else:
+            self.map_catalog = default_map_catalog()
 
         self.csd = None
-        self.com_port = None
-        self.dump_file = None
-        self.parser = None
-        self.leading_mark = None
-        self.img_res = None
+        self.links = []
+        self.link_pool = LinkPool()
+        self.updater_on = False
+        self.ui_tick_cntr = 0
         self.img_rescrop = None
-        self.canv = None
+        # map shown on the canvas, updated in place on every rescale
+        self.canv = ImageTk.PhotoImage('RGB', (MAIN_WINDOW_WIDTH * 2 // 3, MAIN_WINDOW_HEIGHT))
+        self.can.create_image(MAIN_WINDOW_WIDTH // 3, MAIN_WINDOW_HEIGHT // 2, image=self.canv)
 
+        self.bbox_empty = True  # No coordinates of any link yet
         self.coor_min_long, self.coor_max_long = 361.0, -1.0
         self.coor_min_lat, self.coor_max_lat = 361.0, -1.0
 
         self.set_idle_app_state()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.update_status()
+        self.update_charts()
 
     def set_idle_app_state(self, event=None):
         self.bind('<Control-s>', self.open_com_settings_dialog)
         self.bind('<Control-d>', self.open_dump_file)
         self.unbind('<Control-c>')
+        for sequence in ('<space>', '<plus>', '<minus>', '<Control-g>'):
+            self.unbind(sequence)
         self.top_prompt.config(text=SETTINGS_BUTTON_PROMPT)
         self.btm_prompt.config(text=OPEN_DUMP_FILE_PROMPT)
-        if self.com_port:
-            self.com_port.close()
-            self.com_port = None
-        if self.dump_file:
-            self.dump_file = None
-        if self.parser:
-            self.parser.term_sig = True
-            self.parser = None
-        self.coor = []
+        self.link_prompt.config(text='')
+        for link in self.links:
+            link.close()
+            for cell in link.cells:
+                cell.destroy()
+        self.links = []
+        self.bbox_empty = True
+        self.fit_window()
 
     def set_active_app_state(self):
-        self.unbind('<Control-s>',)
-        self.unbind('<Control-d>')
         self.bind('<Control-c>', self.set_idle_app_state)
         self.top_prompt.config(text=STOP_PARSING_PROMPT)
-        self.btm_prompt.config(text='')
+        if any(link.is_replay() for link in self.links):
+            self.bind('<space>', self.toggle_replay_pause)
+            self.bind('<plus>', self.change_replay_speed)
+            self.bind('<minus>', self.change_replay_speed)
+            self.bind('<Control-g>', self.seek_dump)
+            self.btm_prompt.config(text=REPLAY_PROMPT)
+        else:
+            self.btm_prompt.config(text='')
+        if len(self.links) < MAX_LINKS:
+            self.link_prompt.config(text=ADD_LINK_PROMPT)
+        else:
+            self.unbind('<Control-s>')
+            self.unbind('<Control-d>')
+            self.link_prompt.config(text='')
+
+    # Link in the first free slot of MAX_LINKS, its parser is to be started, see frysky_link
+    def new_link(self):
+        link_nums = {link.num for link in self.links}
+        link = Link(min(set(range(MAX_LINKS)) - link_nums), self.metrics)
+        # whole session history of the parameters, older than the retention (seconds) is dropped,
+        # chunks over the memory limit are spilled to the directory, see frysky_history
+        link.history = TelemetryHistory(PacketClock(), self.settings.get('history_retention'),
+                                        self.settings.get('history_spill_dir'))
+        return link
+
+    # Shows the link with the started parser: its column of cells and its track
+    def show_link(self, link):
+        column = 1 + link.num
+        header = Label(self.genpan, text='#{}'.format(link.num + 1), fg=link.color, width=CELL_VALUE_WIDTH)
+        header.grid(row=1, column=column)
+        link.cells = [header]
+        for cells_by_name, cell_rows in ((link.cells_by_name, self.cell_rows),
+                                         (link.status_cells_by_name, self.status_cell_rows)):
+            for name, row in cell_rows.items():
+                cells_by_name[name] = Label(self.genpan, text='n/d', width=CELL_VALUE_WIDTH, anchor='w',
+                                            bg='#eeeeee')
+                cells_by_name[name].grid(row=row, column=column)
+                link.cells.append(cells_by_name[name])
+        link.track = TrackRenderer(self.can, MAIN_WINDOW_WIDTH * 2 // 3, MAIN_WINDOW_HEIGHT, CANVAS_MARGIN_PX,
+                                   link.color, 'track{}'.format(link.num + 1))
+        if not self.bbox_empty:
+            # fixes inside the bbox of the other links don't rescale, they are drawn at its scale
+            link.track.redraw(link.coor.view(), self.coor_min_long, self.coor_min_lat, self.px_per_deg)
+        self.links.append(link)
+        self.links.sort(key=lambda link: link.num)
+        self.fit_window()
+        self.set_active_app_state()
+        if not self.updater_on:
+            self.updater_on = True
+            self.after(10, self.updater)
+
+    # Widens the window when the columns of the links don't fit into its left third
+    def fit_window(self):
+        max_column = max((link.num + 1 for link in self.links), default=1)
+        self.genpan_cap.grid(columnspan=max_column + 1)
+        self.status_cap.grid(columnspan=max_column + 1)
+        self.update_idletasks()
+        extra_width = max(0, self.genpan.winfo_reqwidth() - MAIN_WINDOW_WIDTH // 3)
+        self.geometry('{0}x{1}'.format(MAIN_WINDOW_WIDTH + extra_width, MAIN_WINDOW_HEIGHT + self.charts_height))
 
     def open_com_settings_dialog(self, event):
         self.csd = Toplevel(self)
@@ -145,14 +293,21 @@ class Gui(Tk):
         if 'baudrate_idx' in self.settings:
             self.csd.baudrate_listbox.select_set(self.settings['baudrate_idx'])
         self.csd.baudrate_listbox.grid(row=1, column=1)
+        self.csd.record = IntVar()
+        self.csd.record.set(self.settings.get('record', 0))
+        self.csd.record_checkbutton = Checkbutton(self.csd, text='Record session', variable=self.csd.record)
+        self.csd.record_checkbutton.grid(row=2, column=0, columnspan=2)
         self.csd.ok_button = Button(self.csd, text='Open COM port', command=self.open_com_port)
-        self.csd.ok_button.grid(row=2, column=0, columnspan=2)
+        self.csd.ok_button.grid(row=3, column=0, columnspan=2)
         
     def open_com_port(self):
         com_str = self.csd.com_str.get()
         if not com_str:
             showerror('Error', 'Specify COM-port')
             return
+        if any(link.port_name == com_str for link in self.links):
+            showerror('Error', 'Port is already open')
+            return
         baudrate_idx = self.csd.baudrate_listbox.curselection()
         if not baudrate_idx:
             showerror('Error', 'Specify baud rate')
@@ -161,148 +316,222 @@ class Gui(Tk):
         baudrate = STD_BAUDRATES_TABLE[baudrate_idx]
         self.settings['com_str'] = com_str
         self.settings['baudrate_idx'] = baudrate_idx
-        try:
-            self.com_port = serial.Serial(com_str, baudrate)
-        except serial.SerialException:
-            showerror('Error', 'Can\'t open specified port')
-            return
-        self.parser = FrySkyParserThread(self.com_port)
-        self.parser.start()
-        self.set_active_app_state()
-        self.after(10, self.updater)
+        self.settings['record'] = self.csd.record.get()
+        record_file_name = None
+        if self.csd.record.get():
+            record_file_name = filedialog.asksaveasfilename(defaultextension=RECORD_FILE_EXT,
+                                                            filetypes=(('record', '*' + RECORD_FILE_EXT),
+                                                                       ('all', '*.*')))
+            if not record_file_name:
+                showerror('Error', 'No record file selected')
+                return
+        link = self.new_link()
+        link.port_name = com_str
+        if self.settings.get('decode_process'):
+            # the port is read and decoded in a process of its own, see frysky_process
+            link.start(FrySkyParserProcess(com_str, baudrate, record_file_name, link.metrics))
+            state = link.parser.wait_ready()
+            if state != RUNNING:
+                link.close()
+                showerror('Error', 'Can\'t create record file' if state == RECORD_FAILED
+                          else 'Can\'t open specified port')
+                return
+        else:
+            try:
+                link.com_port = serial.Serial(com_str, baudrate, timeout=SERIAL_READ_TIMEOUT)
+            except serial.SerialException:
+                showerror('Error', 'Can\'t open specified port')
+                link.close()
+                return
+            if record_file_name:
+                try:
+                    link.recorder = FrySkyRecorder(record_file_name)
+                except OSError:
+                    showerror('Error', 'Can\'t create record file')
+                    link.close()
+                    return
+                link.recorder.start()
+            link.start(FrySkyParserThread(link.com_port, link.recorder, link.metrics), self.link_pool)
+        self.show_link(link)
         self.csd.destroy()
 
     def open_dump_file(self, event):
-        dump_file_name = filedialog.askopenfilename(filetypes=(('binary', '*.bin'), ('all', '*.*')))
+        dump_file_name = filedialog.askopenfilename(filetypes=(('binary', '*.bin'),
+                                                                ('record', '*' + RECORD_FILE_EXT),
+                                                                ('all', '*.*')))
         if not dump_file_name:
             showerror('Error', 'No file selected')
             return
         if not os.path.exists(dump_file_name):
             showerror('Error', 'File not found')
             return
-        delay_ms = askfloat('Input', 'Which UI delay set between packets (ms)?')
-        if delay_ms is None:
-            delay_ms = 0.0
-        self.dump_file = open(dump_file_name, 'rb')
-        self.parser = FrySkyParserThread(self.dump_file)
-        self.parser.set_pause(delay_ms)
-        self.parser.start()
-        self.set_active_app_state()
-        self.after(10, self.updater)
+        speed = askfloat('Input', 'Replay speed (0 - as fast as possible)?', initialvalue=1.0, minvalue=0.0)
+        if speed is None:
+            speed = 1.0
+        link = self.new_link()
+        link.dump_file = open(dump_file_name, 'rb')
+        if is_record_file(link.dump_file):
+            # live session records are replayed at their arrival times
+            link.start(FrySkyRecordReplayThread(link.dump_file, speed or None, link.metrics), self.link_pool)
+        else:
+            link.start(FrySkyReplayThread(link.dump_file, speed or None, link.metrics), self.link_pool)
+        self.show_link(link)
+
+    # Replay controls act on all replayed dumps at once, so they stay in step
+    def replay_links(self):
+        return [link for link in self.links if link.is_replay()]
+
+    def toggle_replay_pause(self, event):
+        replay_links = self.replay_links()
+        paused = not replay_links[0].parser.paused
+        for link in replay_links:
+            link.parser.set_paused(paused)
+
+    def change_replay_speed(self, event):
+        replay_links = self.replay_links()
+        speeds = REPLAY_SPEEDS[:-1]  # ascending, as fast as possible is the last one
+        speed = replay_links[0].parser.speed
+        if event.keysym == 'plus':
+            faster = [new_speed for new_speed in speeds if speed is not None and new_speed > speed]
+            speed = faster[0] if faster else None
+        else:
+            slower = [new_speed for new_speed in speeds if speed is None or new_speed < speed]
+            speed = slower[-1] if slower else speeds[0]
+        for link in replay_links:
+            link.parser.set_speed(speed)
+
+    def seek_dump(self, event):
+        dump_time = askfloat('Input', 'Go to dump time (s)?', minvalue=0.0)
+        if dump_time is None:
+            return
+        for link in self.replay_links():
+            link.parser.seek(dump_time)
+            # the track is drawn anew from the new position
+            link.reset_track()
 
     def updater(self):
-        if not self.parser:
+        if not self.links:
+            self.updater_on = False
             return
-
-        self.parser.lock.acquire(blocking=1)
-        new_params = self.parser.out_params
-        self.parser.out_params = []
-        self.parser.lock.release()
-
-        for par_name, par in new_params:
-            if par_name == 'coor':
-                new_coor = par
-                self.coor.append(new_coor)
-                if len(self.coor) == 1:
-                    delta = 0.01
-                    self.coor_max_long = new_coor[0] + delta
-                    self.coor_max_lat = new_coor[1] + delta
-                    self.coor_min_long = new_coor[0] - delta
-                    self.coor_min_lat = new_coor[1] - delta
-                    self.px_per_deg = float(MAIN_WINDOW_HEIGHT) * 0.5 / delta
+        tick_start = time.perf_counter()
+
+        # Only the latest value of each parameter is shown
+        for link in self.links:
+            for par_name, par in link.parser.params.take_latest().items():
+                cell = link.cells_by_name.get(par_name)
+                if cell:
+                    cell.configure(text=str(round(par, 2)))
+
+        # Coordinates which don't fit into the tick time budget are left for the next tick.
+        # Links take turns in going first, so a long backlog of one doesn't hold the others
+        first = self.ui_tick_cntr % len(self.links)
+        self.ui_tick_cntr += 1
+        redraw_needed = False
+        for link in self.links[first:] + self.links[:first]:
+            link.pending_coor.extend(link.parser.params.take_coors())
+            while link.pending_coor and time.perf_counter() - tick_start < UI_TICK_BUDGET:
+                new_coors = link.coor.extend(list(islice(link.pending_coor, UI_COOR_BATCH)))
+                for _ in range(len(new_coors)):
+                    link.pending_coor.popleft()
+                if self.update_bbox(new_coors):
                     redraw_needed = True
-                else:
-                    redraw_needed = False
-
-                if new_coor[0] < self.coor_min_long:
-                    self.coor_min_long = new_coor[0]
-                    redraw_needed = True
-                elif new_coor[0] > self.coor_max_long:
-                    self.coor_max_long = new_coor[0]
-                    redraw_needed = True
-
-                if new_coor[1] < self.coor_min_lat:
-                    self.coor_min_lat = new_coor[1]
-                    redraw_needed = True
-                elif new_coor[1] > self.coor_max_lat:
-                    self.coor_max_lat = new_coor[1]
-                    redraw_needed = True
-
-                if redraw_needed:
-                    can_w = float(MAIN_WINDOW_WIDTH) * 2.0 / 3
-                    can_h = float(MAIN_WINDOW_HEIGHT)
-
-                    self.px_per_deg = min(can_w / float(self.coor_max_long - self.coor_min_long),
-                                          can_h / float(self.coor_max_lat - self.coor_min_lat))
-
-                    self.can_base = ((self.coor[0][0] - self.coor_min_long) * self.px_per_deg,
-                                     can_h - (self.coor[0][1] - self.coor_min_lat) * self.px_per_deg)  # canvas center
-
-                    # calc map scale
-                    map_px_width = round(float(MAP_WIDTH) * self.px_per_deg)
-                    map_trans = float(map_px_width) / float(self.img.size[0])
-                    map_px_height = round(float(self.img.size[1]) * float(map_trans))
-
-                    # transform
-                    self.img_res = self.img.resize((map_px_width, map_px_height), Image.ANTIALIAS)
-
-                    # calculate coordinates of lower left corner
-                    margin_deg = float(CANVAS_MARGIN_PX) / self.px_per_deg
-                    long_llcc = self.coor_min_long - margin_deg
-                    lat_llcc = self.coor_min_lat - margin_deg
-
-                    # calculate map coordinates
-                    map_x_offset = round((long_llcc - MAP_LONG_MIN) * self.px_per_deg)
-                    map_y_offset = round(float(map_px_height) - (lat_llcc - MAP_LAT_MIN) * self.px_per_deg - can_h)
-
-                    self.img_rescrop = self.img_res.crop((map_x_offset, map_y_offset,
-                                                          map_x_offset + can_w, map_y_offset + can_h))
-                    self.img_rescrop.save('tmp.png')
-                    self.canv = PhotoImage(file='tmp.png')
-
-                    self.can.delete("all")
-                    self.can.create_image(300, 300, image=self.canv)
-                    for i in range(len(self.coor) - 1):
-                        self.draw_arc(self.coor[i], self.coor[i + 1])
-                else:
-                    old_coor = self.coor[-2]
-                    self.draw_arc(old_coor, new_coor)
-            else:
-                list(filter(lambda cell: cell['name'] == par_name, self.cells))[0]['cell'].configure(text=str(round(par, 2)))
-
-        self.after(1000, self.updater)
-
-    def draw_arc(self, old_coor, new_coor):
-        delta_x = (new_coor[0] - old_coor[0]) * self.px_per_deg
-        delta_y = -(new_coor[1] - old_coor[1]) * self.px_per_deg
+                elif not redraw_needed:
+                    link.track.add_points(new_coors)
+        if redraw_needed:
+            self.rescale()
+
+        tick_time = time.perf_counter() - tick_start
+        self.ui_tick_time.observe(tick_time)
+        self.after(max(1, round((1.0 / UI_FRAME_RATE - tick_time) * 1000)), self.updater)
+
+    # Extends the bounding box of all tracks with rows of new coordinates. Returns True if it has changed
+    def update_bbox(self, new_coors):
+        if self.bbox_empty:
+            delta = 0.01
+            self.coor_max_long = new_coors[0, 0] + delta
+            self.coor_max_lat = new_coors[0, 1] + delta
+            self.coor_min_long = new_coors[0, 0] - delta
+            self.coor_min_lat = new_coors[0, 1] - delta
+            self.px_per_deg = float(MAIN_WINDOW_HEIGHT) * 0.5 / delta
+            self.bbox_empty = False
+            bbox_changed = True
+        else:
+            bbox_changed = False
+
+        min_long, min_lat = new_coors.min(axis=0)
+        max_long, max_lat = new_coors.max(axis=0)
+        if min_long < self.coor_min_long:
+            self.coor_min_long = min_long
+            bbox_changed = True
+        if max_long > self.coor_max_long:
+            self.coor_max_long = max_long
+            bbox_changed = True
+
+        if min_lat < self.coor_min_lat:
+            self.coor_min_lat = min_lat
+            bbox_changed = True
+        if max_lat > self.coor_max_lat:
+            self.coor_max_lat = max_lat
+            bbox_changed = True
+
+        return bbox_changed
+
+    def update_status(self):
+        snapshot = self.metrics.snapshot()
+        for link in self.links:
+            for name, cell in link.status_cells_by_name.items():
+                val = snapshot.get(link.metrics.prefix + name, snapshot.get(name))
+                if val is None:
+                    continue
+                if isinstance(val, dict):  # histogram of times
+                    val = round(val['p99'] * 1e3, 2)
+                cell.configure(text=str(val))
+        self.after(round(STATUS_UPDATE_PER * 1000), self.update_status)
+
+    # Charts the whole session: from the earliest sample of all links to the latest one
+    def update_charts(self):
+        # Every link is charted from its own start, live links count time by the monotonic
+        # clock and dumps from their beginning
+        histories = [(link.color, link.history, link.history.start_time()) for link in self.links if link.history]
+        histories = [(color, history, t0) for color, history, t0 in histories if t0 is not None]
+        if histories:
+            span = max(history.clock.time - t0 for color, history, t0 in histories)
+            for par_name, chart in self.charts:
+                chart.redraw([(color, history.envelope(par_name, t0, t0 + span, chart.columns()))
+                              for color, history, t0 in histories], 0.0, span)
+        else:
+            for par_name, chart in self.charts:
+                chart.clear()
+        self.after(round(CHART_UPDATE_PER * 1000), self.update_charts)
 
-        new_base_x = self.can_base[0] + delta_x
-        new_base_y = self.can_base[1] + delta_y
-        
-        x1, y1 = self.can_base[0], self.can_base[1]
-        x2, y2 = new_base_x, new_base_y
+    # Fits the map and the tracks of all links into the canvas
+    def rescale(self):
+        can_w = float(MAIN_WINDOW_WIDTH) * 2.0 / 3
+        can_h = float(MAIN_WINDOW_HEIGHT)
 
-        can_w = MAIN_WINDOW_WIDTH * 2 // 3
-        can_h = MAIN_WINDOW_HEIGHT
-        
-        x1_ = (x1 - can_w / 2) * ((can_w - CANVAS_MARGIN_PX) / can_w) + can_w / 2
-        y1_ = (y1 - can_h / 2) * ((can_h - CANVAS_MARGIN_PX) / can_h) + can_h / 2
+        self.px_per_deg = min(can_w / float(self.coor_max_long - self.coor_min_long),
+                              can_h / float(self.coor_max_lat - self.coor_min_lat))
+        self.px_per_deg = 2.0 ** (floor(log2(self.px_per_deg) * ZOOM_STEPS_PER_OCTAVE) / ZOOM_STEPS_PER_OCTAVE)
 
-        x2_ = (x2 - can_w / 2) * ((can_w - CANVAS_MARGIN_PX) / can_w) + can_w / 2
-        y2_ = (y2 - can_h / 2) * ((can_h - CANVAS_MARGIN_PX) / can_h) + can_h / 2
-        
-        self.can.create_line(x1_, y1_, x2_, y2_, smooth=1, width=2, fill='#ee1111')
-        self.can_base = (new_base_x, new_base_y)
+        # calculate coordinates of lower left corner
+        margin_deg = float(CANVAS_MARGIN_PX) / self.px_per_deg
+        long_llcc = self.coor_min_long - margin_deg
+        lat_llcc = self.coor_min_lat - margin_deg
 
-        self.can.create_oval(x2_ - 3, y2_ - 3, x2_ + 3, y2_ + 3, fill='green')
+        # scale only the visible part of the sheets in view
+        self.img_rescrop = self.map_catalog.render(long_llcc, lat_llcc, self.px_per_deg,
+                                                   (round(can_w), round(can_h)))
+        self.canv.paste(self.img_rescrop)
 
-        if self.leading_mark:
-            self.can.delete(self.leading_mark)
-        self.leading_mark = self.can.create_oval(x2_ - 4, y2_ - 4, x2_ + 4, y2_ + 4, fill='red')
+        for link in self.links:
+            link.track.redraw(link.coor.view(), self.coor_min_long, self.coor_min_lat, self.px_per_deg)
 
     def on_closing(self):
         with open(SETTINGS_FILE, 'w') as file:
             json.dump(self.settings, file)  # save current settings
+        for link in self.links:
+            link.close()
+        self.link_pool.close()
         self.destroy()
 
 
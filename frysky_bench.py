@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Benchmarks of the hot paths: simulator, decoder, UI update, map rescale and telemetry
+# history with its charts. The UI runs headless against stubs of the Tk widgets. Run from
+# the project directory (map and GPS track files are looked up there). Results are saved
+# as JSON and can be compared with a previous run
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from frysky import Gui, default_map_catalog, MAIN_WINDOW_WIDTH, MAIN_WINDOW_HEIGHT, CANVAS_MARGIN_PX, UI_FRAME_RATE
+from frysky_chart import StripChart, CHART_HEIGHT, CHART_PAR_NAMES
+from frysky_history import TelemetryHistory
+from frysky_link import Link
+from frysky_metrics import MetricsRegistry
+from frysky_parser import FrySkyDecoder, PacketClock, ParamsBuffer, DECODE_CHUNK_SIZE, PAUSED_FEED_SIZE
+from frysky_sim import gen_frysky_dump, OUT_DATA_RATE
+from frysky_track import TrackRenderer
+
+BENCH_DURATIONS = (60, 300, 1200)  # Lengths of the synthetic dumps, seconds
+BENCH_SEED = 1
+BENCH_REPEAT = 5  # Runs of every benchmark, the best one counts
+REGRESSION_THRESHOLD = 0.1  # Relative change for the worse reported as a regression
+
+
+class StubCanvas:
+
+    def __init__(self):
+        self.items_cntr = 0
+
+    def create_line(self, *args, **kwargs):
+        self.items_cntr += 1
+        return self.items_cntr
+
+    create_oval = create_rectangle = create_text = create_line
+
+    def coords(self, *args):
+        pass
+
+    def delete(self, *args):
+        pass
+
+    def tag_raise(self, *args):
+        pass
+
+
+class StubLabel:
+
+    def configure(self, **kwargs):
+        pass
+
+
+class StubPhotoImage:
+
+    def paste(self, img):
+        pass
+
+
+# Gui updating code running against the widget stubs
+class HeadlessGui:
+    updater = Gui.updater
+    update_bbox = Gui.update_bbox
+    rescale = Gui.rescale
+    update_charts = Gui.update_charts
+
+    def __init__(self, links_num=1):
+        self.map_catalog = default_map_catalog()
+        self.canv = StubPhotoImage()
+        self.img_rescrop = None
+        self.px_per_deg = Gui.px_per_deg
+        self.metrics = MetricsRegistry()
+        self.ui_tick_time = self.metrics.histogram('ui.tick_time')
+        self.ui_tick_cntr = 0
+        self.bbox_empty = True
+        self.links = []
+        can = StubCanvas()
+        for link_num in range(links_num):
+            link = Link(link_num, self.metrics)
+            link.parser = SimpleNamespace(params=ParamsBuffer())
+            link.cells_by_name = {cell['name']: StubLabel() for cell in Gui.cells}
+            link.track = TrackRenderer(can, MAIN_WINDOW_WIDTH * 2 // 3, MAIN_WINDOW_HEIGHT, CANVAS_MARGIN_PX,
+                                       link.color)
+            self.links.append(link)
+        self.charts = [(par_name, StripChart(can, 0, chart_no * CHART_HEIGHT, MAIN_WINDOW_WIDTH, CHART_HEIGHT,
+                                             par_name, 'chart{}'.format(chart_no + 1)))
+                       for chart_no, par_name in enumerate(CHART_PAR_NAMES)]
+
+    def after(self, ms, func):
+        pass
+
+
+def add_metric(results, name, value, unit, better):
+    results.append({'name': name, 'value': value, 'unit': unit, 'better': better})
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def percentile(sorted_vals, share):
+    return sorted_vals[min(int(len(sorted_vals) * share), len(sorted_vals) - 1)]
+
+
+# Generates the dumps, returns their file names by duration
+def bench_simulator(results, dumps_dir, durations, repeat):
+    dumps = {}
+    for duration in durations:
+        dump_file_name = os.path.join(dumps_dir, 'sim_{}s.bin'.format(duration))
+        gen_time = best_time(lambda: gen_frysky_dump(dump_file_name, duration, OUT_DATA_RATE, BENCH_SEED), repeat)
+        dump_size = os.path.getsize(dump_file_name)
+        add_metric(results, 'sim.packets_per_s[{}s]'.format(duration), duration * OUT_DATA_RATE / gen_time,
+                   'packets/s', 'higher')
+        add_metric(results, 'sim.mb_per_s[{}s]'.format(duration), dump_size / gen_time / 1e6, 'MB/s', 'higher')
+        dumps[duration] = dump_file_name
+    return dumps
+
+
+def bench_decoder(results, dumps, repeat):
+    for duration, dump_file_name in dumps.items():
+        with open(dump_file_name, 'rb') as dump_file:
+            data = dump_file.read()
+        decoders = []
+
+        def decode():
+            decoder = FrySkyDecoder()
+            for i in range(0, len(data), DECODE_CHUNK_SIZE):
+                decoder.feed(data[i:i + DECODE_CHUNK_SIZE])
+            decoders.append(decoder)
+
+        decode_time = best_time(decode, repeat)
+        add_metric(results, 'decoder.mb_per_s[{}s]'.format(duration), len(data) / decode_time / 1e6, 'MB/s',
+                   'higher')
+        add_metric(results, 'decoder.frames_per_s[{}s]'.format(duration), decoders[-1].frames_cntr / decode_time,
+                   'frames/s', 'higher')
+
+    # Feeding packet by packet, as a serial port delivers them
+    with open(dumps[min(dumps)], 'rb') as dump_file:
+        data = dump_file.read()
+    decoder = FrySkyDecoder()
+    feed_times = []
+    for i in range(0, len(data), PAUSED_FEED_SIZE):
+        chunk = data[i:i + PAUSED_FEED_SIZE]
+        start = time.perf_counter()
+        decoder.feed(chunk)
+        feed_times.append(time.perf_counter() - start)
+    feed_times.sort()
+    add_metric(results, 'decoder.frame_latency_us.median', 1e6 * percentile(feed_times, 0.5), 'us', 'lower')
+    add_metric(results, 'decoder.frame_latency_us.p99', 1e6 * percentile(feed_times, 0.99), 'us', 'lower')
+
+
+# Replays the dump into the headless UI in real time portions, one per UI tick
+def bench_ui(results, dump_file_name, duration, repeat):
+    with open(dump_file_name, 'rb') as dump_file:
+        data = dump_file.read()
+    tick_size = max(1, round(len(data) / duration / UI_FRAME_RATE))
+    decoder = FrySkyDecoder()
+    portions = [decoder.feed(data[i:i + tick_size]) for i in range(0, len(data), tick_size)]
+
+    tick_times = []
+    for _ in range(repeat):
+        gui = HeadlessGui()
+        for records in portions:
+            gui.links[0].parser.params.push(records)
+            start = time.perf_counter()
+            gui.updater()
+            tick_times.append(time.perf_counter() - start)
+    tick_times.sort()
+    add_metric(results, 'ui.tick_ms.mean', 1e3 * sum(tick_times) / len(tick_times), 'ms', 'lower')
+    add_metric(results, 'ui.tick_ms.p99', 1e3 * percentile(tick_times, 0.99), 'ms', 'lower')
+    add_metric(results, 'ui.tick_ms.max', 1e3 * tick_times[-1], 'ms', 'lower')
+
+    # Rescale of the whole track, with scaled map tiles cached or not
+    def rescale_cold():
+        gui.map_catalog.tiles.clear()
+        gui.rescale()
+
+    add_metric(results, 'ui.rescale_ms.cold', 1e3 * best_time(rescale_cold, repeat), 'ms', 'lower')
+    add_metric(results, 'ui.rescale_ms.warm', 1e3 * best_time(gui.rescale, repeat), 'ms', 'lower')
+
+
+# Feeds the decoded dumps to the history and charts it, the charts should take about the
+# same time whatever the duration
+def bench_charts(results, dumps, repeat):
+    for duration, dump_file_name in dumps.items():
+        with open(dump_file_name, 'rb') as dump_file:
+            data = dump_file.read()
+        decoder = FrySkyDecoder()
+        portions = [decoder.feed(data[i:i + DECODE_CHUNK_SIZE]) for i in range(0, len(data), DECODE_CHUNK_SIZE)]
+        records_num = sum(len(records) for records in portions)
+        histories = []
+
+        def feed():
+            history = TelemetryHistory(PacketClock())
+            for records in portions:
+                history.feed(records)
+            histories.append(history)
+
+        add_metric(results, 'history.records_per_s[{}s]'.format(duration), records_num / best_time(feed, repeat),
+                   'records/s', 'higher')
+        gui = HeadlessGui()
+        gui.links[0].history = histories[-1]
+        add_metric(results, 'ui.charts_ms[{}s]'.format(duration), 1e3 * best_time(gui.update_charts, repeat), 'ms',
+                   'lower')
+
+
+def run_benchmarks(durations, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as dumps_dir:
+        dumps = bench_simulator(results, dumps_dir, durations, repeat)
+        bench_decoder(results, dumps, repeat)
+        ui_duration = min(dumps)
+        bench_ui(results, dumps[ui_duration], ui_duration, repeat)
+        bench_charts(results, dumps, repeat)
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'durations': list(durations),
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+
+# Prints the metrics against the baseline ones. Returns names of metrics changed for the
+# worse by more than the threshold
+def compare(report, baseline, threshold):
+    baseline_metrics = {metric['name']: metric for metric in baseline['results']}
+    regressions = []
+    for metric in report['results']:
+        baseline_metric = baseline_metrics.get(metric['name'])
+        if not baseline_metric or not baseline_metric['value']:
+            print('{0:40} {1:12.3f} {2}'.format(metric['name'], metric['value'], metric['unit']))
+            continue
+        change = metric['value'] / baseline_metric['value'] - 1.0
+        worse = -change if metric['better'] == 'higher' else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(metric['name'])
+            flag = 'REGRESSION'
+        print('{0:40} {1:12.3f} {2:10} {3:+7.1f}% {4}'.format(metric['name'], metric['value'], metric['unit'],
+                                                              change * 100.0, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks of FrySky hot paths')
+    arg_parser.add_argument('-o', '--output', help='JSON file to save the results to')
+    arg_parser.add_argument('-c', '--compare', help='JSON file of the baseline results')
+    arg_parser.add_argument('-t', '--threshold', type=float, default=REGRESSION_THRESHOLD,
+                            help='relative change for the worse reported as a regression')
+    arg_parser.add_argument('-d', '--durations', type=int, nargs='+', default=BENCH_DURATIONS,
+                            help='lengths of the synthetic dumps, seconds')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=BENCH_REPEAT, help='runs of every benchmark')
+    args = arg_parser.parse_args()
+
+    report = run_benchmarks(args.durations, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    baseline = {'results': []}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    regressions = compare(report, baseline, args.threshold)
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
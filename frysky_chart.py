@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Strip charts of parameters over the whole session. Every chart is drawn from envelopes
+# of the histories sized to its width in pixels, see TelemetryHistory.envelope(), so it
+# takes as many canvas points for a flight of hours as for a minute of it
+
+import numpy as np
+
+CHART_TAG = 'chart'
+CHART_HEIGHT = 80  # Of one chart, pixels
+CHART_MARGIN_PX = 4  # Between the plot and the chart borders
+CHART_UPDATE_PER = 1.0  # Period of the charts update, seconds
+CHART_PAR_NAMES = ('vlt', 'cur', 'gnd_speed')  # Charted by default
+CHART_BG_COLOR = '#f4f4f4'
+CHART_TEXT_COLOR = '#444444'
+
+
+# Chart of one parameter of all links in a box of the canvas
+class StripChart:
+
+    def __init__(self, can, x, y, width, height, caption, tag=CHART_TAG):
+        self.can = can
+        self.caption = caption
+        self.tag = tag  # Canvas items of every chart on the canvas have their own tag
+        self.x0, self.y0 = x, y
+        self.x1, self.y1 = x + width, y + height
+        self.plot_x0, self.plot_y0 = x + CHART_MARGIN_PX, y + CHART_MARGIN_PX
+        self.plot_y1 = self.y1 - CHART_MARGIN_PX
+
+    # Pixel columns of the plot, the envelopes are to be taken at this width
+    def columns(self):
+        return self.x1 - self.x0 - 2 * CHART_MARGIN_PX
+
+    def clear(self):
+        self.can.delete(self.tag)
+
+    # Draws the series over the time span, a series is (color, envelope), envelope is
+    # (columns, minimums, maximums). The values are scaled to fit all series in
+    def redraw(self, series, t0, t1):
+        self.clear()
+        self.can.create_rectangle(self.x0, self.y0, self.x1, self.y1, fill=CHART_BG_COLOR, outline='',
+                                  tags=self.tag)
+        series = [(color, envelope) for color, envelope in series if envelope is not None]
+        if series:
+            val_min = min(float(envelope[1].min()) for color, envelope in series)
+            val_max = max(float(envelope[2].max()) for color, envelope in series)
+            caption = '{0}: {1} .. {2}'.format(self.caption, round(val_min, 2), round(val_max, 2))
+        else:
+            caption = self.caption
+        self.can.create_text(self.x0 + CHART_MARGIN_PX, self.y0 + CHART_MARGIN_PX, text=caption, anchor='nw',
+                             fill=CHART_TEXT_COLOR, tags=self.tag)
+        self.can.create_text(self.x1 - CHART_MARGIN_PX, self.y0 + CHART_MARGIN_PX,
+                             text='{} s'.format(round(t1 - t0)), anchor='ne', fill=CHART_TEXT_COLOR,
+                             tags=self.tag)
+        if not series:
+            return
+
+        if val_max == val_min:
+            val_min, val_max = val_min - 0.5, val_max + 0.5  # a flat line in the middle
+        px_per_val = (self.plot_y1 - self.plot_y0) / (val_max - val_min)
+        for color, (cols, mins, maxs) in series:
+            x = self.plot_x0 + cols
+            y_top = self.plot_y1 - (maxs - val_min) * px_per_val
+            y_bottom = self.plot_y1 - (mins - val_min) * px_per_val
+            # down and up every column, so the line covers the whole range of its samples
+            if len(cols) > 1:
+                points = np.column_stack((x, y_top, x, y_bottom)).ravel().tolist()
+            else:
+                points = np.array((x[0] - 1, y_top[0], x[0] + 1, y_bottom[0])).tolist()  # a single column is a tick
+            self.can.create_line(*points, fill=color, tags=self.tag)
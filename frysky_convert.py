@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from itertools import islice
+from multiprocessing import Pool
+import argparse
+import csv
+import mmap
+import os
+import sys
+from frysky_parser import FrySkyDecoder, FRAME_RE, IDLE, DECODE_CHUNK_SIZE, HUB_PART_METHODS, hub_pars,\
+    new_column, new_columns, append_records, decode_file
+
+CONVERT_SPAN_SIZE = 1 << 22  # Bytes of a dump decoded by one task of the pool
+CONVERT_FORMATS = ('csv', 'npz', 'parquet')
+
+# Names of the raw parts of multi-part hub parameters by PRIM
+part_names = {prim: 'part_{:02X}'.format(prim) for prim, (par_name, method_name, arg) in hub_pars.items()
+              if method_name in HUB_PART_METHODS}
+
+
+# Leaves parts of multi-part parameters, e.g. coordinates, as they are. Spans of a dump are
+# decoded apart, so the parts are put together only when the spans are stitched in the dump order
+class HubPartsDecoder(FrySkyDecoder):
+    hub_dispatch = tuple((part_names[prim], None, None) if prim in part_names else hub_par
+                         for prim, hub_par in enumerate(FrySkyDecoder.hub_dispatch))
+
+
+def get_decoder_state(decoder):
+    return (decoder.state, decoder.pack_cntr, decoder.is_spec_byte_met, decoder.hub_prim, decoder.par_lsb_byte,
+            decoder.pack_start)
+
+
+# Spans of the dump, every span but the first one starts with a well-formed packet
+def split_dump(path, span_size=CONVERT_SPAN_SIZE):
+    with open(path, 'rb') as dump_file:
+        dump_size = os.fstat(dump_file.fileno()).st_size
+        if not dump_size:
+            return []
+        span_starts = [0]
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for span_start in range(span_size, dump_size, span_size):
+                match = FRAME_RE.search(dump, max(span_start, span_starts[-1] + 1))
+                if match is None:
+                    break
+                span_starts.append(match.start())
+    return list(zip(span_starts, span_starts[1:] + [dump_size]))
+
+
+# Decodes a span of the dump starting in the decoder state given, fresh decoder if None.
+# Returns columns of the span, hub parts as (offset, PRIM, value) and the decoder state at the span end
+def decode_span(path, start, end, entry_state=None):
+    decoder = HubPartsDecoder()
+    decoder.bytes_cntr = start
+    if entry_state is not None:
+        (decoder.state, decoder.pack_cntr, decoder.is_spec_byte_met, decoder.hub_prim, decoder.par_lsb_byte,
+         decoder.pack_start) = entry_state
+    with open(path, 'rb') as dump_file:
+        columns = new_columns(os.fstat(dump_file.fileno()).st_size)
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for chunk_start in range(start, end, DECODE_CHUNK_SIZE):
+                offsets = []
+                records = decoder.feed(dump[chunk_start:min(chunk_start + DECODE_CHUNK_SIZE, end)], offsets)
+                if chunk_start + DECODE_CHUNK_SIZE >= end:
+                    records += decoder.flush(offsets)  # the span ends in the state of the byte-wise decoding
+                append_records(columns, records, offsets)
+    hub_parts = sorted((offset, prim, int(val))
+                       for prim, part_name in part_names.items() if part_name in columns
+                       for offset, val in zip(*columns.pop(part_name).values()))
+    return columns, hub_parts, get_decoder_state(decoder)
+
+
+# Spans are decoded speculatively, a span whose start turns out to be inside a packet is
+# decoded again when they are stitched
+def decode_span_task(task):
+    return decode_span(*task)
+
+
+# Puts decoded spans together as if the dump was decoded at once. A span whose start turns
+# out to be inside a packet is decoded again from the state the previous span ended in
+def stitch_spans(path, spans, results):
+    columns = new_columns(os.path.getsize(path))
+    decoder = FrySkyDecoder()  # puts the parts together
+    prev_end_state = None
+    for (start, end), result in zip(spans, results):
+        if prev_end_state is not None and prev_end_state[0] != IDLE:
+            result = decode_span(path, start, end, prev_end_state)
+        span_columns, hub_parts, end_state = result
+        for par_name, span_column in span_columns.items():
+            column = columns.get(par_name)
+            if column is None:
+                column = columns[par_name] = new_column(par_name, span_column['offset'].typecode)
+            for field, values in span_column.items():
+                column[field].extend(values)
+        records = []
+        offsets = []
+        for offset, prim, val in hub_parts:
+            decoder.push_hub_param(prim, val & 0xFF, val >> 8, records)
+            offsets += [offset] * (len(records) - len(offsets))
+        append_records(columns, records, offsets)
+        prev_end_state = end_state
+    return columns
+
+
+# Decodes the dumps with the pool, spans of all dumps are decoded together.
+# Yields (path, columns) in the order of the paths
+def decode_files(pool, paths, span_size=CONVERT_SPAN_SIZE):
+    spans_by_path = [(path, split_dump(path, span_size)) for path in paths]
+    tasks = [(path, start, end) for path, spans in spans_by_path for start, end in spans]
+    results = pool.imap(decode_span_task, tasks)
+    for path, spans in spans_by_path:
+        yield path, stitch_spans(path, spans, islice(results, len(spans)))
+
+
+def write_csv(columns, out_base):
+    for par_name, column in columns.items():
+        if not column['offset']:
+            continue
+        with open('{}.{}.csv'.format(out_base, par_name), 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(column.keys())
+            # floats are written with the digits they keep, not those of the doubles they are read as
+            writer.writerows(zip(*(map('{:.7g}'.format, values) if values.typecode == 'f' else values
+                                   for values in column.values())))
+
+
+def write_npz(columns, out_base):
+    import numpy
+    numpy.savez(out_base + '.npz', **{par_name + '_' + field: numpy.frombuffer(values, values.typecode)
+                                      for par_name, column in columns.items() if column['offset']
+                                      for field, values in column.items()})
+
+
+def write_parquet(columns, out_base):
+    import numpy
+    import pyarrow
+    import pyarrow.parquet
+    for par_name, column in columns.items():
+        if not column['offset']:
+            continue
+        table = pyarrow.table({field: numpy.frombuffer(values, values.typecode) for field, values in column.items()})
+        pyarrow.parquet.write_table(table, '{}.{}.parquet'.format(out_base, par_name))
+
+
+writers = {
+    'csv': write_csv,
+    'npz': write_npz,
+    'parquet': write_parquet
+}
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='python -m frysky_parser')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help='decode dump files into columnar files')
+    convert.add_argument('dumps', nargs='+', help='dump files')
+    convert.add_argument('-f', '--format', choices=CONVERT_FORMATS, default='csv', help='output format')
+    convert.add_argument('-o', '--out-dir', help='output directory, the dump directory by default')
+    convert.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                         help='decoding processes, 1 decodes in this process')
+    convert.add_argument('--span-size', type=int, default=CONVERT_SPAN_SIZE,
+                         help='bytes of a dump decoded by one task')
+    args = arg_parser.parse_args(argv)
+
+    write = writers[args.format]
+
+    def out_base(path):
+        dump_dir, dump_name = os.path.split(path)
+        return os.path.join(args.out_dir or dump_dir, os.path.splitext(dump_name)[0])
+
+    try:
+        if args.jobs == 1:
+            for path in args.dumps:
+                write(decode_file(path), out_base(path))
+        else:
+            with Pool(args.jobs) as pool:
+                for path, columns in decode_files(pool, args.dumps, args.span_size):
+                    write(columns, out_base(path))
+    except ImportError as e:
+        sys.exit('Can\'t write {} files: {}'.format(args.format, e))
+
+
+if __name__ == '__main__':
+    main()
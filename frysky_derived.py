@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Parameters derived from the decoded ones as they stream: consumed capacity, distance and
+# ground speed from the GPS fixes, statistics of the voltage and the current over the
+# last window. Every sample updates them in constant time, no history is rescanned.
+# Records are timed by a PacketClock of frysky_parser: arrival time of the data on live
+# links, telemetry packets in dumps
+
+from collections import deque
+from math import asin, cos, radians, sin, sqrt
+
+EARTH_RADIUS_M = 6371000.0
+ROLLING_WINDOW = 10.0  # Span of the voltage and current statistics, seconds
+MIN_FIX_INTERVAL = 0.5  # Shortest time ground speed is computed over, seconds
+
+DERIVED_PAR_NAMES = ('cap', 'dist', 'gnd_speed',
+                     'vlt_min', 'vlt_max', 'vlt_mean', 'cur_min', 'cur_max', 'cur_mean')
+
+
+# Great circle distance between (longitude, latitude) points in degrees, meters
+def haversine(coor_1, coor_2):
+    long_1, lat_1 = radians(coor_1[0]), radians(coor_1[1])
+    long_2, lat_2 = radians(coor_2[0]), radians(coor_2[1])
+    a = sin((lat_2 - lat_1) / 2) ** 2 + cos(lat_1) * cos(lat_2) * sin((long_2 - long_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * asin(min(1.0, sqrt(a)))
+
+
+# Minimum, maximum and mean of the samples of the last window. Monotonic deques keep the
+# samples which may still become the minimum or the maximum, a running sum the mean
+class RollingStats:
+
+    def __init__(self, window=ROLLING_WINDOW):
+        self.window = window
+        self.samples = deque()  # (time, value)
+        self.mins = deque()  # Samples with values increasing from the minimum
+        self.maxs = deque()  # Samples with values decreasing from the maximum
+        self.sum = 0.0
+
+    def push(self, t, val):
+        sample = (t, val)
+        samples, mins, maxs = self.samples, self.mins, self.maxs
+        samples.append(sample)
+        self.sum += val
+        while mins and mins[-1][1] >= val:
+            mins.pop()
+        mins.append(sample)
+        while maxs and maxs[-1][1] <= val:
+            maxs.pop()
+        maxs.append(sample)
+
+        start = t - self.window
+        if samples[0][0] <= start:
+            while samples[0][0] <= start:
+                self.sum -= samples.popleft()[1]
+            while mins[0][0] <= start:
+                mins.popleft()
+            while maxs[0][0] <= start:
+                maxs.popleft()
+
+    def min(self):
+        return self.mins[0][1]
+
+    def max(self):
+        return self.maxs[0][1]
+
+    def mean(self):
+        return self.sum / len(self.samples)
+
+
+class DerivedParams:
+
+    def __init__(self, clock, window=ROLLING_WINDOW):
+        self.clock = clock  # PacketClock of frysky_parser the records are timed by
+        self.cap = 0.0  # mAh
+        self.cur = None  # (time, value) of the latest current sample
+        self.dist = 0.0  # m
+        self.fix = None  # Latest GPS fix
+        self.speed_fix = None  # (time, distance) of the fix the ground speed is counted from
+        self.gnd_speed = None  # km/h
+        self.vlt_stats = RollingStats(window)
+        self.cur_stats = RollingStats(window)
+
+    # Updates the derived parameters with the records which arrived at the time given, or,
+    # if it isn't, with the records of the telemetry packets following the previous ones.
+    # Returns records of those changed, the latest values only
+    def feed(self, records, arrival_time=None):
+        vlt_changed = cur_changed = coor_changed = False
+        vlt_push, cur_push = self.vlt_stats.push, self.cur_stats.push
+        for (par_name, par_val), t in zip(records, self.clock.times(records, arrival_time)):
+            if par_name == 'vlt':
+                vlt_push(t, par_val)
+                vlt_changed = True
+            elif par_name == 'cur':
+                if self.cur is not None:
+                    # trapezoids, A * s to mAh
+                    self.cap += (self.cur[1] + par_val) * 0.5 * (t - self.cur[0]) / 3.6
+                self.cur = (t, par_val)
+                cur_push(t, par_val)
+                cur_changed = True
+            elif par_name == 'coor':
+                if self.fix is not None:
+                    self.dist += haversine(self.fix, par_val)
+                    if t - self.speed_fix[0] >= MIN_FIX_INTERVAL:
+                        self.gnd_speed = (self.dist - self.speed_fix[1]) / (t - self.speed_fix[0]) * 3.6
+                        self.speed_fix = (t, self.dist)
+                else:
+                    self.speed_fix = (t, self.dist)
+                self.fix = par_val
+                coor_changed = True
+
+        derived = []
+        if vlt_changed:
+            vlt_stats = self.vlt_stats
+            derived += (('vlt_min', vlt_stats.min()), ('vlt_max', vlt_stats.max()), ('vlt_mean', vlt_stats.mean()))
+        if cur_changed:
+            cur_stats = self.cur_stats
+            derived += (('cap', self.cap),
+                        ('cur_min', cur_stats.min()), ('cur_max', cur_stats.max()), ('cur_mean', cur_stats.mean()))
+        if coor_changed:
+            derived.append(('dist', self.dist))
+            if self.gnd_speed is not None:
+                derived.append(('gnd_speed', self.gnd_speed))
+        return derived
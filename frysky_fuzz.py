@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Equivalence check of the decoder: FrySkyDecoder.feed() taking runs of packets and single
+# packets by regular expressions, with packets cut by the chunk end decoded along with the
+# next chunk and flushed at the end, has to give the same records, packet offsets, counters
+# and state as the byte-wise state machine alone, however the stream is chunked. Streams
+# are the dumps given, random bytes biased towards the special ones and pieces of the
+# dumps with bytes changed, inserted and deleted. A difference is printed with the stream
+# and the chunking to reproduce it. Envelopes of the telemetry history over spans shorter
+# than a chunk and with too few blocks in them for a column have to be those of the
+# samples themselves
+
+from bisect import bisect_right
+import argparse
+import os
+import random
+import sys
+import numpy as np
+from frysky_history import TelemetryHistory, HISTORY_CHUNK, HISTORY_BLOCK, ENVELOPE_ENTRIES_PER_COLUMN
+from frysky_parser import FrySkyDecoder, PacketClock, IDLE, PAUSED_FEED_SIZE
+
+FUZZ_SEED = 1
+FUZZ_STREAMS = 20000  # Random streams checked
+FUZZ_CHUNKINGS = 4  # Random chunkings of every stream
+FUZZ_DUMP_CHUNKINGS = 3  # Random chunkings of every dump, besides the whole dump and packet sizes
+FUZZ_STREAM_MAX = 200  # Bytes of a random stream at most
+FUZZ_MUTATIONS_MAX = 6  # Changes of a piece of a dump at most
+FUZZ_SPEC_BYTES = (0x7E, 0x5E, 0x7D, 0x5D, 0xFE, 0x7E ^ 0x20, 0x5E ^ 0x60, 0x03, 0x12, 0x1A, 0x13, 0x1B, 0x22,
+                   0x23, 0x06, 0x10, 0x21, 0x00, 0xFF)  # Framing bytes and PRIMs of hub parameters
+FUZZ_SPEC_SHARE = 0.7  # Of random bytes taken from FUZZ_SPEC_BYTES
+FUZZ_ENVELOPES = 2000  # Random spans the history envelopes are checked over
+FUZZ_HISTORY_CHUNKS = 6  # Chunks of the history checked
+FUZZ_ENVELOPE_COLUMNS = (1, 7, 100, 640)  # Pixel columns of the envelopes
+
+
+# What has to be equal: records, offsets, counters and the state the stream ends in
+def decoder_result(decoder, records, offsets):
+    state = (decoder.state, decoder.is_spec_byte_met, decoder.pack_cntr if decoder.state != IDLE else None)
+    return (records, offsets, decoder.frames_cntr, decoder.dropped_frames_cntr, decoder.unknown_hub_ids_cntr,
+            decoder.bytes_cntr, state)
+
+
+def decode_bytewise(data):
+    decoder = FrySkyDecoder()
+    records = []
+    offsets = []
+    pos = 0
+    while pos < len(data):
+        pos = decoder.decode_bytes(data, pos, records, offsets)
+    decoder.bytes_cntr = len(data)
+    return decoder_result(decoder, records, offsets)
+
+
+def decode_chunks(data, chunk_sizes):
+    decoder = FrySkyDecoder()
+    records = []
+    offsets = []
+    pos = 0
+    for chunk_size in chunk_sizes:
+        chunk_offsets = []
+        chunk_records = decoder.feed(memoryview(data)[pos:pos + chunk_size], chunk_offsets)
+        if len(chunk_offsets) != len(chunk_records):
+            raise AssertionError('{} offsets of {} records'.format(len(chunk_offsets), len(chunk_records)))
+        records += chunk_records
+        offsets += chunk_offsets
+        pos += chunk_size
+    records += decoder.flush(offsets)
+    return decoder_result(decoder, records, offsets)
+
+
+def random_chunk_sizes(rnd, data_len, max_size):
+    chunk_sizes = []
+    while sum(chunk_sizes) < data_len:
+        chunk_sizes.append(rnd.randint(1, max_size))
+    return chunk_sizes
+
+
+def random_stream(rnd):
+    return bytes(rnd.choice(FUZZ_SPEC_BYTES) if rnd.random() < FUZZ_SPEC_SHARE else rnd.randrange(256)
+                 for _ in range(rnd.randint(1, FUZZ_STREAM_MAX)))
+
+
+# A piece of the dump with random bytes changed, inserted or deleted
+def mutated_piece(rnd, dump):
+    start = rnd.randrange(len(dump))
+    piece = bytearray(dump[start:start + rnd.randint(1, FUZZ_STREAM_MAX)])
+    for _ in range(rnd.randint(1, FUZZ_MUTATIONS_MAX)):
+        pos = rnd.randrange(len(piece) + 1)
+        byte = rnd.choice(FUZZ_SPEC_BYTES) if rnd.random() < FUZZ_SPEC_SHARE else rnd.randrange(256)
+        action = rnd.randrange(3)
+        if action == 0 and pos < len(piece):
+            piece[pos] = byte
+        elif action == 1:
+            piece.insert(pos, byte)
+        elif pos < len(piece) and len(piece) > 1:
+            del piece[pos]
+    return bytes(piece)
+
+
+# Returns a description of the first difference or None
+def check_stream(data, chunkings):
+    expected = decode_bytewise(data)
+    for chunk_sizes in chunkings:
+        if decode_chunks(data, chunk_sizes) != expected:
+            return 'stream {}, chunks {}'.format(data.hex() if len(data) <= FUZZ_STREAM_MAX * 2 else
+                                                 '{} bytes'.format(len(data)), chunk_sizes)
+    return None
+
+
+# Minimum and maximum per pixel column of the samples themselves, see bin_envelope() of
+# frysky_history: the span takes in the sample covering t0
+def samples_envelope(times, vals, t0, t1, columns):
+    start, end = max(bisect_right(times, t0) - 1, 0), bisect_right(times, t1)
+    envelope = {}
+    for t, val in zip(times[start:end], vals[start:end]):
+        col = min(max(int((t - t0) * (columns / (t1 - t0))), 0), columns - 1)
+        col_min, col_max = envelope.get(col, (val, val))
+        envelope[col] = (min(col_min, val), max(col_max, val))
+    cols = sorted(envelope)
+    return cols, [envelope[col][0] for col in cols], [envelope[col][1] for col in cols]
+
+
+# Samples come at uneven times, so chunks of the history differ in length. Returns
+# descriptions of the differences
+def check_envelopes(rnd, spans_num):
+    history = TelemetryHistory(PacketClock())
+    times = []
+    vals = []
+    t = 0.0
+    for sample_no in range(FUZZ_HISTORY_CHUNKS * HISTORY_CHUNK + rnd.randrange(HISTORY_CHUNK)):
+        t += rnd.expovariate(1.0) * (10.0 if rnd.random() < 0.01 else 0.01)
+        times.append(t)
+        vals.append(rnd.gauss(0.0, 1.0))
+        history.feed([('val', vals[-1])], t)
+    chunk_times = times[::HISTORY_CHUNK]
+    block_times = times[:len(times) - len(times) % HISTORY_BLOCK:HISTORY_BLOCK]
+    differences = []
+    for _ in range(spans_num):
+        chunk_no = rnd.randrange(len(chunk_times))
+        chunk_end = chunk_times[chunk_no + 1] if chunk_no + 1 < len(chunk_times) else times[-1]
+        t0 = rnd.uniform(chunk_times[chunk_no], chunk_end)
+        t1 = rnd.uniform(t0, chunk_end)
+        columns = rnd.choice(FUZZ_ENVELOPE_COLUMNS)
+        if t1 <= t0 or bisect_right(block_times, t1) - bisect_right(block_times, t0) >= \
+                ENVELOPE_ENTRIES_PER_COLUMN * columns:
+            continue  # the blocks are fine enough
+        envelope = history.envelope('val', t0, t1, columns)
+        expected = samples_envelope(times, vals, t0, t1, columns)
+        if envelope is None or not all(np.array_equal(got, want) for got, want in zip(envelope, expected)):
+            differences.append('envelope of {} .. {} in {} columns, chunk {}'.format(t0, t1, columns, chunk_no))
+    return differences
+
+
+def run_fuzz(dump_file_names, streams_num, seed, envelopes_num=FUZZ_ENVELOPES):
+    rnd = random.Random(seed)
+    differences = []
+    dumps = []
+    for dump_file_name in dump_file_names:
+        with open(dump_file_name, 'rb') as dump_file:
+            dumps.append(dump_file.read())
+        data = dumps[-1]
+        chunkings = [[len(data)], [PAUSED_FEED_SIZE] * (len(data) // PAUSED_FEED_SIZE + 1)] +\
+                    [random_chunk_sizes(rnd, len(data), max_size) for max_size in (64, 4096, 1 << 16)
+                     for _ in range(FUZZ_DUMP_CHUNKINGS)]
+        difference = check_stream(data, chunkings)
+        if difference:
+            differences.append('{}: {}'.format(dump_file_name, difference))
+    dumps = [dump for dump in dumps if dump]
+
+    for stream_no in range(streams_num):
+        data = mutated_piece(rnd, rnd.choice(dumps)) if dumps and stream_no % 2 else random_stream(rnd)
+        chunkings = [[len(data)]] + [random_chunk_sizes(rnd, len(data), rnd.choice((1, 7, 16, 64)))
+                                     for _ in range(FUZZ_CHUNKINGS)]
+        difference = check_stream(data, chunkings)
+        if difference:
+            differences.append(difference)
+    return differences + check_envelopes(rnd, envelopes_num)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Equivalence check of the FrySky decoder')
+    arg_parser.add_argument('dumps', nargs='*', help='dump files to check, dump.bin if there is one')
+    arg_parser.add_argument('-n', '--streams', type=int, default=FUZZ_STREAMS, help='random streams checked')
+    arg_parser.add_argument('-e', '--envelopes', type=int, default=FUZZ_ENVELOPES,
+                            help='random spans of the history envelopes checked')
+    arg_parser.add_argument('-s', '--seed', type=int, default=FUZZ_SEED, help='seed of the random streams')
+    args = arg_parser.parse_args()
+
+    dump_file_names = args.dumps or [file_name for file_name in ('dump.bin',) if os.path.exists(file_name)]
+    differences = run_fuzz(dump_file_names, args.streams, args.seed, args.envelopes)
+    for difference in differences[:10]:
+        print(difference)
+    print('{} dumps, {} streams, {} envelopes, {} differences'.format(len(dump_file_names), args.streams,
+                                                                     args.envelopes, len(differences)))
+    if differences:
+        sys.exit(1)
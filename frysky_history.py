@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# History of the scalar parameters of a link, a column per parameter. Samples are appended
+# to typed arrays, every HISTORY_CHUNK of them are sealed into a NumPy chunk. Minimum and
+# maximum of every HISTORY_BLOCK samples and of every chunk are kept aside, so an envelope
+# of any time span for a chart is taken from at most a few entries per pixel column, the
+# length of the history doesn't matter. Chunks older than the retention are dropped, old
+# chunks over the memory limit are spilled to files and mapped back when read. Samples
+# are timed by a PacketClock of frysky_parser: arrival time on live links, telemetry
+# packets in dumps
+
+from array import array
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+HISTORY_CHUNK = 4096  # Samples of a sealed chunk
+HISTORY_BLOCK = 64  # Samples summarised by one entry of the block level
+BLOCKS_PER_CHUNK = HISTORY_CHUNK // HISTORY_BLOCK
+HISTORY_MEMORY_SAMPLES = 1 << 20  # Samples of a parameter kept in memory when spilling is on
+HISTORY_ROWS_CAPACITY = 1024  # Rows of a summary level there is room for initially
+ENVELOPE_ENTRIES_PER_COLUMN = 2  # Fewest entries per pixel column a coarser level is taken at
+
+
+# Rows of float columns in a growable array, dropped from the front
+class Rows:
+
+    def __init__(self, width, capacity=HISTORY_ROWS_CAPACITY):
+        self.rows = np.empty((capacity, width))
+        self.first = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.first
+
+    def append(self, row):
+        if self.end == len(self.rows):
+            rows_num = self.end - self.first
+            if rows_num * 2 > len(self.rows):
+                rows = np.empty((len(self.rows) * 2, self.rows.shape[1]))
+                rows[:rows_num] = self.rows[self.first:self.end]
+                self.rows = rows
+            else:
+                self.rows[:rows_num] = self.rows[self.first:self.end]  # room left by the dropped rows
+            self.first, self.end = 0, rows_num
+        self.rows[self.end] = row
+        self.end += 1
+
+    def drop(self, rows_num):
+        self.first += rows_num
+
+    def view(self):
+        return self.rows[self.first:self.end]
+
+
+# Minimum and maximum per pixel column of the entries (times, minimums, maximums) sorted
+# by time. Returns (columns, minimums, maximums) of the columns which have any entries
+def bin_envelope(times, mins, maxs, t0, t1, columns):
+    start, end = np.searchsorted(times, (t0, t1), side='right')
+    start = max(start - 1, 0)  # the entry covering t0
+    times, mins, maxs = times[start:end], mins[start:end], maxs[start:end]
+    if not len(times):
+        return None
+    cols = np.clip(((times - t0) * (columns / (t1 - t0))).astype(np.int64), 0, columns - 1)
+    starts = np.flatnonzero(np.concatenate(((True,), cols[1:] != cols[:-1])))
+    return cols[starts], np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts)
+
+
+class ParamColumn:
+
+    def __init__(self, retention=None, spill_prefix=None, memory_samples=HISTORY_MEMORY_SAMPLES):
+        self.retention = retention
+        self.spill_prefix = spill_prefix  # Spill files start with it, None: nothing is spilled
+        self.memory_chunks = max(1, memory_samples // HISTORY_CHUNK)
+        self.times = array('d')  # Samples of the chunk being filled
+        self.vals = array('d')
+        self.chunks = []  # (times, values) of sealed chunks, mapped files of the spilled ones
+        self.spill_files = []  # Of the spilled chunks, which are the first ones
+        self.spill_cntr = 0
+        self.chunk_rows = Rows(4)  # First time, last time, minimum and maximum of sealed chunks
+        self.block_rows = Rows(3)  # First time, minimum and maximum of every full block
+
+    # Called after every HISTORY_BLOCK samples
+    def add_block(self):
+        block = self.vals[-HISTORY_BLOCK:]
+        self.block_rows.append((self.times[-HISTORY_BLOCK], min(block), max(block)))
+        if len(self.vals) == HISTORY_CHUNK:
+            self.seal()
+
+    def seal(self):
+        times, vals = np.array(self.times), np.array(self.vals)
+        self.times, self.vals = array('d'), array('d')
+        blocks = self.block_rows.view()[-BLOCKS_PER_CHUNK:]
+        self.chunk_rows.append((times[0], times[-1], blocks[:, 1].min(), blocks[:, 2].max()))
+        self.chunks.append((times, vals))
+        if self.retention is not None:
+            self.drop_before(times[-1] - self.retention)
+        if self.spill_prefix and len(self.chunks) - len(self.spill_files) > self.memory_chunks:
+            self.spill()
+
+    # Writes the oldest chunk still in memory to a file and maps it back
+    def spill(self):
+        chunk_no = len(self.spill_files)
+        file_name = '{0}{1}.npy'.format(self.spill_prefix, self.spill_cntr)
+        self.spill_cntr += 1
+        np.save(file_name, np.stack(self.chunks[chunk_no]))
+        chunk = np.load(file_name, mmap_mode='r')
+        self.chunks[chunk_no] = (chunk[0], chunk[1])
+        self.spill_files.append(file_name)
+
+    # Drops the chunks which end before the time
+    def drop_before(self, t):
+        chunks_num = int(np.searchsorted(self.chunk_rows.view()[:, 1], t))
+        if not chunks_num:
+            return
+        del self.chunks[:chunks_num]
+        for file_name in self.spill_files[:chunks_num]:
+            os.remove(file_name)
+        del self.spill_files[:chunks_num]
+        self.chunk_rows.drop(chunks_num)
+        self.block_rows.drop(chunks_num * BLOCKS_PER_CHUNK)
+
+    def start_time(self):
+        if len(self.chunk_rows):
+            return self.chunk_rows.view()[0, 0]
+        return self.times[0] if self.times else None
+
+    # Minimum and maximum of the samples from t0 to t1 per pixel column, from the coarsest
+    # level which still has enough entries starting in the span, so a short span inside
+    # long chunks is taken from the blocks or the samples. See bin_envelope()
+    def envelope(self, t0, t1, columns):
+        chunk_rows, block_rows = self.chunk_rows.view(), self.block_rows.view()
+        # The chunk with the sample covering t0, which ends before t0 if t0 is after its end
+        first_chunk = max(int(np.searchsorted(chunk_rows[:, 0], t0, side='right')) - 1, 0)
+        end_chunk = int(np.searchsorted(chunk_rows[:, 0], t1, side='right'))
+        if end_chunk == len(chunk_rows):  # the span reaches the chunk being filled
+            filling_blocks = block_rows[len(chunk_rows) * BLOCKS_PER_CHUNK:]
+            tail_times = np.array(self.times[len(filling_blocks) * HISTORY_BLOCK:])
+            tail_vals = np.array(self.vals[len(filling_blocks) * HISTORY_BLOCK:])
+        else:
+            filling_blocks = block_rows[:0]
+            tail_times = tail_vals = np.empty(0)
+        min_entries = ENVELOPE_ENTRIES_PER_COLUMN * columns
+        span_chunks = np.searchsorted(chunk_rows[:, 0], (t0, t1), side='right')
+        span_blocks = np.searchsorted(block_rows[:, 0], (t0, t1), side='right')
+        if span_chunks[1] - span_chunks[0] >= min_entries:
+            rows = np.concatenate((chunk_rows[first_chunk:end_chunk, [0, 2, 3]], filling_blocks))
+        elif span_blocks[1] - span_blocks[0] >= min_entries:
+            rows = block_rows[first_chunk * BLOCKS_PER_CHUNK:end_chunk * BLOCKS_PER_CHUNK + len(filling_blocks)]
+        else:
+            chunks = self.chunks[first_chunk:end_chunk] + [(tail_times, tail_vals)]
+            if len(filling_blocks):
+                chunks[-1] = (np.array(self.times), np.array(self.vals))
+            times = np.concatenate([chunk[0] for chunk in chunks])
+            vals = np.concatenate([chunk[1] for chunk in chunks])
+            return bin_envelope(times, vals, vals, t0, t1, columns)
+        times = np.concatenate((rows[:, 0], tail_times))
+        mins = np.concatenate((rows[:, 1], tail_vals))
+        maxs = np.concatenate((rows[:, 2], tail_vals))
+        return bin_envelope(times, mins, maxs, t0, t1, columns)
+
+    def close(self):
+        self.chunks = []
+        for file_name in self.spill_files:
+            os.remove(file_name)
+        self.spill_files = []
+
+
+class TelemetryHistory:
+
+    def __init__(self, clock, retention=None, spill_dir=None, memory_samples=HISTORY_MEMORY_SAMPLES):
+        self.lock = threading.Lock()  # Fed by the parser, read by the UI
+        self.clock = clock  # Its time is that of the latest sample
+        self.retention = retention  # Seconds, None: everything is kept
+        self.memory_samples = memory_samples
+        # Files of the spilled chunks go to a directory of their own
+        self.spill_dir = tempfile.mkdtemp(prefix='frysky_history_', dir=spill_dir) if spill_dir else None
+        self.columns = {}
+
+    def new_column(self, par_name):
+        spill_prefix = os.path.join(self.spill_dir, par_name + '_') if self.spill_dir else None
+        return ParamColumn(self.retention, spill_prefix, self.memory_samples)
+
+    # Appends the scalar parameters of the records which arrived at the time given, or, if
+    # it isn't, of the telemetry packets following the previous ones. Coordinates are kept
+    # by the track
+    def feed(self, records, arrival_time=None):
+        with self.lock:
+            columns = self.columns
+            for (par_name, par_val), t in zip(records, self.clock.times(records, arrival_time)):
+                if par_val.__class__ is tuple:
+                    continue
+                column = columns.get(par_name)
+                if column is None:
+                    column = columns[par_name] = self.new_column(par_name)
+                column.times.append(t)
+                vals = column.vals
+                vals.append(par_val)
+                if not len(vals) % HISTORY_BLOCK:
+                    column.add_block()
+
+    # Forgets everything, the history goes on from the time, e.g. after a seek
+    def clear(self, start_time=0.0):
+        with self.lock:
+            for column in self.columns.values():
+                column.close()
+            self.columns = {}
+            self.clock.time = start_time
+
+    def start_time(self):
+        with self.lock:
+            start_times = [column.start_time() for column in self.columns.values()]
+        start_times = [start_time for start_time in start_times if start_time is not None]
+        return min(start_times) if start_times else None
+
+    # See ParamColumn.envelope(). Returns None if the parameter has no samples in the span
+    def envelope(self, par_name, t0, t1, columns):
+        with self.lock:
+            column = self.columns.get(par_name)
+            if column is None or t1 <= t0:
+                return None
+            return column.envelope(t0, t1, columns)
+
+    def close(self):
+        with self.lock:
+            for column in self.columns.values():
+                column.close()
+            self.columns = {}
+            if self.spill_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None  # a parser not stopped yet may still feed it
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+from frysky_parser import FrySkyDecoder, PacketClock, DECODE_CHUNK_SIZE, TEL_PACK_PAR_NAME, offsets_typecode
+
+INDEX_FILE_EXT = '.idx'
+INDEX_MAGIC = b'FSKYIDX2'
+INDEX_HEADER = struct.Struct('<8sQqQ')  # magic, dump size, dump mtime (ns), number of packets
+
+
+# Offsets of the telemetry packets of a dump file. Dump time of a packet is that of its
+# number on the PacketClock, hub packets go along with the telemetry packet before them
+class DumpIndex:
+
+    def __init__(self, offsets=None):
+        self.offsets = offsets if offsets is not None else array('I')
+        self.clock = PacketClock()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Returns (offset, dump time) of the last packet starting not later than the dump time
+    def find(self, dump_time):
+        packet_no = min(self.clock.packet_no(dump_time), len(self.offsets) - 1)
+        if packet_no < 0:
+            return 0, 0.0
+        return self.offsets[packet_no], self.clock.packet_time(packet_no)
+
+
+def index_file_name(dump_file_name):
+    return dump_file_name + INDEX_FILE_EXT
+
+
+def build_index(dump_file_name):
+    decoder = FrySkyDecoder()
+    last_offset = -1
+    with open(dump_file_name, 'rb') as dump_file:
+        dump_size = os.fstat(dump_file.fileno()).st_size
+        index = DumpIndex(array(offsets_typecode(dump_size)))
+        if not dump_size:
+            return index
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for chunk_start in range(0, dump_size, DECODE_CHUNK_SIZE):
+                offsets = []
+                records = decoder.feed(dump[chunk_start:chunk_start + DECODE_CHUNK_SIZE], offsets)
+                if chunk_start + DECODE_CHUNK_SIZE >= dump_size:
+                    records += decoder.flush(offsets)  # the packet cut by the end of the dump
+                for (par_name, par_val), offset in zip(records, offsets):
+                    if par_name == TEL_PACK_PAR_NAME and offset != last_offset:
+                        index.offsets.append(offset)
+                        last_offset = offset
+    return index
+
+
+def save_index(index, dump_file_name):
+    stat = os.stat(dump_file_name)
+    offsets = index.offsets
+    if sys.byteorder != 'little':
+        offsets = array(offsets.typecode, offsets)
+        offsets.byteswap()
+    with open(index_file_name(dump_file_name), 'wb') as index_file:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(index)))
+        offsets.tofile(index_file)
+
+
+# Returns the saved index of the dump or None if there is none or it's outdated
+def load_index(dump_file_name):
+    try:
+        stat = os.stat(dump_file_name)
+        with open(index_file_name(dump_file_name), 'rb') as index_file:
+            magic, dump_size, dump_mtime, packets_num = INDEX_HEADER.unpack(index_file.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC or dump_size != stat.st_size or dump_mtime != stat.st_mtime_ns:
+                return None
+            index = DumpIndex(array(offsets_typecode(dump_size)))
+            index.offsets.fromfile(index_file, packets_num)
+    except (OSError, EOFError, struct.error):
+        return None
+    if sys.byteorder != 'little':
+        index.offsets.byteswap()
+    return index
+
+
+# Returns the saved index of the dump, the index is built and saved if needed
+def get_index(dump_file_name):
+    index = load_index(dump_file_name)
+    if index is None:
+        index = build_index(dump_file_name)
+        try:
+            save_index(index, dump_file_name)
+        except OSError:
+            pass  # the index is still usable in memory
+    return index
+
+
+if __name__ == '__main__':
+    for file_name in sys.argv[1:]:
+        save_index(build_index(file_name), file_name)
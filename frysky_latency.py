@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Measures latency from a byte written to a serial port to the decoded value, using a pty
+# as a stand-in for the port. The port is read and decoded as the panel does it: by a port
+# reader thread and a worker pool, see frysky_link
+
+import os
+import sys
+import time
+import serial
+from frysky_link import LinkPool
+from frysky_parser import FrySkyParserThread, SERIAL_READ_TIMEOUT
+
+PACKETS_NUM = 200
+PACKET_PER = 0.02  # Period of packets sending, seconds
+POLL_PER = 0.0005  # Period of checking for the decoded value, seconds
+WAIT_TIMEOUT = 1.0  # Longest wait for a packet to be decoded, seconds
+IDLE_TIME = 2.0  # Time of measuring CPU usage with no data, seconds
+
+
+def tel_packet(marker):
+    # Marker goes as signal level, it's kept below special bytes so no stuffing is needed
+    return b'\x7E\xFE\x00\x00' + marker.to_bytes(1, byteorder='big') + b'\x00\x00\x00\x00\x00\x7E'
+
+
+def measure_latency():
+    master_fd, slave_fd = os.openpty()
+    port = serial.Serial(os.ttyname(slave_fd), timeout=SERIAL_READ_TIMEOUT)
+    parser = FrySkyParserThread(port)
+    parser.params.subscribe('sig_lev')
+    pool = LinkPool()
+    pool.add(parser)
+
+    latencies = []
+    lost = 0
+    try:
+        for packet_no in range(PACKETS_NUM):
+            marker = packet_no % 100
+            sent_time = time.perf_counter()
+            os.write(master_fd, tel_packet(marker))
+            while True:
+                if marker in parser.params.take_samples('sig_lev'):
+                    latencies.append(time.perf_counter() - sent_time)
+                    break
+                if time.perf_counter() - sent_time > WAIT_TIMEOUT:
+                    lost += 1
+                    break
+                time.sleep(POLL_PER)
+            time.sleep(PACKET_PER)
+
+        # CPU usage of the whole process while the port is silent
+        cpu_time = time.process_time()
+        time.sleep(IDLE_TIME)
+        idle_cpu = (time.process_time() - cpu_time) / IDLE_TIME
+    finally:
+        parser.term_sig = True
+        pool.remove(parser)
+        pool.close()
+        port.close()
+        os.close(master_fd)
+        os.close(slave_fd)
+
+    return latencies, lost, idle_cpu
+
+
+if __name__ == '__main__':
+    latencies, lost, idle_cpu = measure_latency()
+    if not latencies:
+        print('No packets decoded')
+        sys.exit(1)
+    latencies.sort()
+    print('Packets: {0}, lost: {1}'.format(len(latencies), lost))
+    print('Latency, ms: mean {0:.2f}, median {1:.2f}, 99% {2:.2f}, max {3:.2f}'.format(
+        1e3 * sum(latencies) / len(latencies),
+        1e3 * latencies[len(latencies) // 2],
+        1e3 * latencies[int(len(latencies) * 0.99)],
+        1e3 * latencies[-1]))
+    print('Idle CPU usage: {0:.1f}%'.format(idle_cpu * 100.0))
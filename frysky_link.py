@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Several telemetry links watched at once. Parsers of all links are stepped by one pool of
+# worker threads instead of a thread each: a worker takes the parser due first and runs
+# one step of it, see poll() of FrySkyParserThread and FrySkyReplayThread. A step never
+# waits for data, so a link with nothing to read doesn't hold a worker. Serial ports are
+# waited on by a reader thread per port, which wakes its parser when a chunk arrives
+
+from collections import deque
+from itertools import count
+import heapq
+import os
+import threading
+import time
+import traceback
+from frysky_metrics import MetricsScope
+from frysky_parser import SERIAL_READ_TIMEOUT
+from frysky_track import TrackStore
+
+LINK_POOL_WORKERS = min(4, os.cpu_count() or 1)
+LINK_COLORS = ('#ee1111', '#1144ee', '#11aa33', '#ee8800', '#aa22bb', '#119999')  # Tracks, by link number
+MAX_LINKS = len(LINK_COLORS)
+
+
+class LinkPool:
+
+    def __init__(self, workers_num=LINK_POOL_WORKERS):
+        self.cond = threading.Condition()
+        self.queue = []  # Heap of (due time, sequence number, parser)
+        self.sequence = count()  # Keeps parsers due at the same time in the order they were queued
+        self.poll_lags = {}  # Added parsers and histograms of the delays of their steps
+        self.polled = set()  # Parsers being stepped by the workers
+        self.idle = set()  # Parsers waiting to be woken, see wake()
+        self.woken = set()  # Parsers woken while being stepped
+        self.readers = {}  # Threads reading the serial ports by parser
+        self.term_sig = False
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers_num)]
+        for worker in self.workers:
+            worker.start()
+
+    def add(self, parser, poll_lag=None):
+        with self.cond:
+            self.poll_lags[parser] = poll_lag
+            heapq.heappush(self.queue, (time.monotonic(), next(self.sequence), parser))
+            self.cond.notify()
+        if parser.reads_port():
+            reader = self.readers[parser] = threading.Thread(target=self.read_port, args=(parser,), daemon=True)
+            reader.start()
+
+    def read_port(self, parser):
+        try:
+            parser.read_port(lambda: self.wake(parser))
+        except Exception:
+            # the parser stops as its thread would, the other links go on
+            traceback.print_exc()
+            parser.term_sig = True
+
+    # Queues the parser which waits for data to be stepped now
+    def wake(self, parser):
+        with self.cond:
+            if parser in self.idle:
+                self.idle.discard(parser)
+                heapq.heappush(self.queue, (time.monotonic(), next(self.sequence), parser))
+                self.cond.notify()
+            elif parser in self.polled:
+                self.woken.add(parser)  # the step may have missed the data
+
+    # Takes the parser out of the pool, waits for its step in progress to end and for its
+    # port reader to stop, so the port can be closed. The parser is to be stopped first
+    def remove(self, parser):
+        with self.cond:
+            self.poll_lags.pop(parser, None)
+            self.queue = [entry for entry in self.queue if entry[2] is not parser]
+            heapq.heapify(self.queue)
+            self.idle.discard(parser)
+            while parser in self.polled:
+                self.cond.wait()
+            self.woken.discard(parser)
+            reader = self.readers.pop(parser, None)
+        if reader:
+            reader.join(SERIAL_READ_TIMEOUT * 2)  # don't close the port under a blocked read
+
+    def work(self):
+        cond = self.cond
+        while True:
+            with cond:
+                while not self.term_sig:
+                    now = time.monotonic()
+                    if self.queue and self.queue[0][0] <= now:
+                        break
+                    cond.wait(self.queue[0][0] - now if self.queue else None)
+                if self.term_sig:
+                    return
+                due_time, sequence, parser = heapq.heappop(self.queue)
+                poll_lag = self.poll_lags[parser]
+                self.polled.add(parser)
+            if poll_lag is not None:
+                poll_lag.observe(now - due_time)
+            try:
+                delay = parser.poll()
+            except Exception:
+                # the parser stops as its thread would, the other links go on
+                traceback.print_exc()
+                parser.term_sig = True
+            with cond:
+                self.polled.discard(parser)
+                if parser in self.poll_lags and not parser.term_sig:
+                    if delay is not None:
+                        heapq.heappush(self.queue, (time.monotonic() + delay, next(self.sequence), parser))
+                    elif parser in self.woken:
+                        heapq.heappush(self.queue, (time.monotonic(), next(self.sequence), parser))
+                    else:
+                        self.idle.add(parser)
+                self.woken.discard(parser)
+                cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.term_sig = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+# One link: its parser with the port, dump or record file it reads, and the track and the
+# cells it is shown in. Metrics of the parser are kept under 'link<number>.' names
+class Link:
+
+    def __init__(self, link_num, metrics):
+        self.num = link_num
+        self.color = LINK_COLORS[link_num]
+        self.metrics = MetricsScope(metrics, 'link{}.'.format(link_num + 1))
+        self.poll_lag = self.metrics.histogram('link.poll_lag')
+        self.port_name = None  # of a serial link
+        self.parser = None
+        self.pool = None  # Steps the parser, None if the parser is a thread of its own
+        self.com_port = None
+        self.dump_file = None
+        self.recorder = None
+        self.coor = TrackStore()
+        self.pending_coor = deque()
+        self.track = None  # TrackRenderer, set by the UI
+        self.history = None  # TelemetryHistory the strip charts are drawn from, set by the UI
+        self.cells = []  # Widgets of the link column, set by the UI
+        self.cells_by_name = {}  # Labels of the parameters
+        self.status_cells_by_name = {}  # Labels of the metrics
+
+    # Parsers which can be stepped go to the pool, the rest are started as threads
+    def start(self, parser, pool=None):
+        self.parser = parser
+        if self.history is not None:
+            parser.params.history = self.history
+        if pool is not None and hasattr(parser, 'poll'):
+            self.pool = pool
+            pool.add(parser, self.poll_lag)
+        else:
+            parser.start()
+
+    def is_replay(self):
+        return hasattr(self.parser, 'seek')
+
+    def reset_track(self):
+        self.coor = TrackStore()
+        self.pending_coor = deque()
+        if self.track:
+            self.track.clear()
+
+    def close(self):
+        if self.parser:
+            self.parser.term_sig = True
+            if self.pool:
+                self.pool.remove(self.parser)
+            else:
+                self.parser.join(SERIAL_READ_TIMEOUT * 2)  # don't close the port under a blocked read
+            self.parser = None
+        if self.recorder:
+            self.recorder.term_sig = True
+            self.recorder.join()  # the rest of the record is written
+            self.recorder = None
+        if self.com_port:
+            self.com_port.close()
+            self.com_port = None
+        if self.dump_file:
+            self.dump_file.close()
+            self.dump_file = None
+        if self.track:
+            self.track.clear()
+        if self.history:
+            self.history.close()
+            self.history = None
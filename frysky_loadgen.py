@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Streams synthetic or recorded telemetry into ptys, one per link, which the panel or the
+# headless consumer opens as serial ports. Sequence markers are put between packets to
+# measure end-to-end latency and loss
+
+import argparse
+import os
+import select
+import sys
+import threading
+import time
+import tty
+import numpy as np
+import serial
+from frysky_link import LinkPool
+from frysky_parser import FrySkyDecoder, FrySkyParserThread, FRAME_RE, IDLE, SERIAL_READ_TIMEOUT
+from frysky_record import RecordReader, is_record_file
+from frysky_sim import gen_frysky_chunks, hub_packets, stuff_packets, T_OVERALL, OUT_DATA_RATE
+
+LOADGEN_PACE_TICK = 0.005  # Period of writing when the output is paced, seconds
+LOADGEN_BLOCK_SIZE = 4096  # Bytes written at once at maximum rate
+LOADGEN_READ_SIZE = 1 << 20  # Bytes of a dump file read at once
+BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+# Markers are hub packets of a PRIM no sensor sends: the panel skips them as unknown, the
+# headless consumer decodes them with MarkerDecoder. Their values are sequence numbers
+MARKER_PRIM = 0x50
+MARKER_PAR_NAME = 'marker'
+MARKER_SEQ_MOD = 0x10000
+MARKER_PER = 0.1  # Stream time between markers, seconds
+MARKER_EVERY_BYTES = 1 << 14  # Bytes between markers at maximum rate
+DRAIN_TIME = 0.5  # Wait for the last markers after the stream ends, seconds
+
+
+def marker_packet(seq):
+    return stuff_packets(hub_packets(MARKER_PRIM, np.array([seq % MARKER_SEQ_MOD])), np.zeros(1, bool))
+
+
+# Decodes the markers as MARKER_PAR_NAME samples besides the telemetry
+class MarkerDecoder(FrySkyDecoder):
+    hub_dispatch = tuple((MARKER_PAR_NAME, None, None) if prim == MARKER_PRIM else hub_par
+                         for prim, hub_par in enumerate(FrySkyDecoder.hub_dispatch))
+
+
+# Data of a dump or a record file, chunk by chunk
+def file_chunks(file_name):
+    with open(file_name, 'rb') as file:
+        if is_record_file(file):
+            reader = RecordReader(file)
+            while True:
+                chunk = reader.read_next()
+                if chunk is None:
+                    return
+                yield chunk
+        else:
+            for chunk in iter(lambda: file.read(LOADGEN_READ_SIZE), b''):
+                yield chunk
+
+
+class FrySkyLoadGenerator(threading.Thread):
+
+    def __init__(self, chunks, baudrate=None):
+        threading.Thread.__init__(self)
+        self.chunks = chunks
+        self.bytes_per_s = baudrate / BITS_PER_BYTE if baudrate else None
+        if self.bytes_per_s:
+            self.block_size = max(1, round(self.bytes_per_s * LOADGEN_PACE_TICK))
+            self.marker_every = max(1, round(self.bytes_per_s * MARKER_PER))
+        else:
+            self.block_size = LOADGEN_BLOCK_SIZE
+            self.marker_every = MARKER_EVERY_BYTES
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)  # a full pty doesn't keep the thread from stopping
+        self.port_name = os.ttyname(self.slave_fd)
+        self.term_sig = False
+        self.bytes_sent = 0
+        self.markers_sent = 0
+        self.marker_times = {}  # Send times of the latest markers by sequence number mod MARKER_SEQ_MOD
+        self.clock_start = None
+        # Follows the stream, so markers go only between packets. A packet start can't be told
+        # by its first byte: hub packets begin and end with the same byte
+        self.framer = FrySkyDecoder()
+
+    def run(self):
+        self.clock_start = time.monotonic()
+        to_marker = self.marker_every
+        try:
+            for chunk in self.chunks:
+                pos = 0
+                while pos < len(chunk) and not self.term_sig:
+                    match = FRAME_RE.search(chunk, pos + max(to_marker, 1))
+                    end = match.start() if match else len(chunk)
+                    self.framer.feed(chunk[pos:end])
+                    self.write(chunk[pos:end])
+                    to_marker -= end - pos
+                    pos = end
+                    if match is None or self.framer.state != IDLE or self.framer.cut_packet:
+                        continue
+                    self.marker_times[self.markers_sent % MARKER_SEQ_MOD] = time.perf_counter()
+                    self.write(marker_packet(self.markers_sent))
+                    self.markers_sent += 1
+                    to_marker = self.marker_every
+                if self.term_sig:
+                    break
+        except OSError:
+            pass  # the port was closed
+
+    # Writes the data paced by the baud rate, if any
+    def write(self, data):
+        for i in range(0, len(data), self.block_size):
+            block = data[i:i + self.block_size]
+            if self.bytes_per_s:
+                delay = self.clock_start + (self.bytes_sent + len(block)) / self.bytes_per_s - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            while block and not self.term_sig:
+                select.select([], [self.master_fd], [], SERIAL_READ_TIMEOUT)
+                try:
+                    block = block[os.write(self.master_fd, block):]
+                except BlockingIOError:
+                    pass
+            self.bytes_sent += len(data[i:i + self.block_size])
+
+    def close(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+# Reads the ptys as the panel would and measures latency of the markers, the parsers are
+# threads or are stepped by the pool. Returns per generator (latencies, markers received,
+# bytes received, markers dropped by the params buffer)
+def consume(generators, pool=None):
+    ports = [serial.Serial(generator.port_name, timeout=SERIAL_READ_TIMEOUT) for generator in generators]
+    parsers = [FrySkyParserThread(port) for port in ports]
+    for parser in parsers:
+        parser.decoder = MarkerDecoder()
+        parser.params.subscribe(MARKER_PAR_NAME)
+        if pool:
+            pool.add(parser)
+        else:
+            parser.start()
+    latencies = [[] for _ in generators]
+    markers_received = [0] * len(generators)
+    drain_end = None
+    try:
+        while ((drain_end is None or time.monotonic() < drain_end) and
+               all(parser.is_alive() or pool and not parser.term_sig for parser in parsers)):
+            if drain_end is None and not any(generator.is_alive() for generator in generators):
+                drain_end = time.monotonic() + DRAIN_TIME
+            receive_time = time.perf_counter()
+            for i, (generator, parser) in enumerate(zip(generators, parsers)):
+                for seq in parser.params.take_samples(MARKER_PAR_NAME):
+                    markers_received[i] += 1
+                    sent_time = generator.marker_times.get(seq)
+                    if sent_time is not None:
+                        latencies[i].append(receive_time - sent_time)
+            time.sleep(LOADGEN_PACE_TICK)
+    finally:
+        for parser in parsers:
+            parser.term_sig = True
+            if pool:
+                pool.remove(parser)
+            else:
+                parser.join()
+        for port in ports:
+            port.close()
+    return [(latencies[i], markers_received[i], parser.decoder.bytes_cntr,
+             parser.params.drops(MARKER_PAR_NAME))
+            for i, parser in enumerate(parsers)]
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Streams FrySky telemetry into a pty')
+    arg_parser.add_argument('-b', '--baudrate', type=int, default=115200, help='output baud rate, 0 - maximum rate')
+    arg_parser.add_argument('-i', '--input', help='dump or record file to stream instead of synthetic data')
+    arg_parser.add_argument('-d', '--duration', type=float, default=T_OVERALL, help='synthetic data length, seconds')
+    arg_parser.add_argument('-r', '--rate', type=int, default=OUT_DATA_RATE, help='synthetic telemetry packets per second')
+    arg_parser.add_argument('-s', '--seed', type=int, help='random generator seed')
+    arg_parser.add_argument('-n', '--links', type=int, default=1, help='ptys streamed at once')
+    arg_parser.add_argument('-c', '--consume', action='store_true', help='read the ptys with headless parsers')
+    arg_parser.add_argument('-p', '--pool', action='store_true', help='step the parsers by one worker pool')
+    args = arg_parser.parse_args()
+
+    generators = []
+    for link_num in range(args.links):
+        if args.input:
+            chunks = file_chunks(args.input)
+        else:
+            chunks = gen_frysky_chunks(args.duration, args.rate, None if args.seed is None else args.seed + link_num)
+        generators.append(FrySkyLoadGenerator(chunks, args.baudrate))
+        print('Serial port: ' + generators[-1].port_name)
+    pool = LinkPool() if args.pool else None
+    start_time = time.monotonic()
+    for generator in generators:
+        generator.start()
+    try:
+        if args.consume:
+            consumed = consume(generators, pool)
+        for generator in generators:
+            generator.join()
+    except KeyboardInterrupt:
+        for generator in generators:
+            generator.term_sig = True
+            generator.join()
+        sys.exit(1)
+    finally:
+        stream_time = time.monotonic() - start_time
+        for generator in generators:
+            generator.close()
+        if pool:
+            pool.close()
+
+    for link_num, generator in enumerate(generators):
+        if len(generators) > 1:
+            print('Link {}'.format(link_num + 1))
+        print('Sent: {0} bytes, {1} markers, {2:.1f} kB/s'.format(
+            generator.bytes_sent, generator.markers_sent, generator.bytes_sent / stream_time / 1e3))
+        if not args.consume:
+            continue
+        latencies, markers_received, bytes_received, markers_dropped = consumed[link_num]
+        print('Received: {0} bytes, {1} markers, lost {2}, dropped by the buffer {3}'.format(
+            bytes_received, markers_received, generator.markers_sent - markers_received, markers_dropped))
+        if latencies:
+            latencies.sort()
+            print('Latency, ms: mean {0:.2f}, median {1:.2f}, 99% {2:.2f}, max {3:.2f}'.format(
+                1e3 * sum(latencies) / len(latencies),
+                1e3 * latencies[len(latencies) // 2],
+                1e3 * latencies[int(len(latencies) * 0.99)],
+                1e3 * latencies[-1]))
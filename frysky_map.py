@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Map sheets are raster images with bounds in degrees. A catalog keeps them in a grid
+# index, only the sheets in view are decoded, at the lowest resolution that still covers
+# the scale they are shown at, and dropped when others take their room
+
+from collections import OrderedDict, defaultdict
+from math import ceil, floor, log2
+import json
+import os
+from PIL import Image
+
+TILE_SIZE = 256  # Side of a scaled map tile, pixels
+TILE_CACHE_SIZE = 128  # Scaled tiles kept in memory
+MAP_BG_COLOR = (255, 255, 255)  # Color of areas out of the map
+MAP_INDEX_CELL_DEG = 0.1  # Side of a cell of the sheet index grid, degrees
+MAP_MAX_REDUCE = 32  # Largest factor a sheet is decoded reduced by
+MAP_DECODED_PX = 16 * 1000 * 1000  # Pixels of decoded sheets kept in memory, besides those in view
+MAP_SHEET_EXTS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+MAP_BOUNDS_EXT = '.json'
+
+
+class MapPyramid:
+
+    def __init__(self, img, tiles=None, key=None):
+        self.size = img.size
+        # Levels of detail, each next one is twice smaller than the previous
+        self.levels = [img.convert('RGB')]
+        while max(self.levels[-1].size) > TILE_SIZE:
+            prev_level = self.levels[-1]
+            self.levels.append(prev_level.resize((ceil(prev_level.size[0] / 2), ceil(prev_level.size[1] / 2)),
+                                                 Image.LANCZOS))
+        self.tiles = tiles if tiles is not None else OrderedDict()  # LRU cache of scaled tiles, may be shared
+        self.key = key  # Tells tiles of this pyramid in a shared cache
+
+    # Pixels of all levels
+    def area(self):
+        return sum(level.size[0] * level.size[1] for level in self.levels)
+
+    # Returns the box of the map scaled to map_size
+    def render(self, map_size, box):
+        x0, y0, x1, y1 = box
+        window = Image.new('RGB', (x1 - x0, y1 - y0), MAP_BG_COLOR)
+        self.paste_into(window, map_size, box)
+        return window
+
+    # Pastes the part of the box covered by the map scaled to map_size into the window of the box
+    def paste_into(self, window, map_size, box):
+        x0, y0, x1, y1 = box
+        tx0, ty0 = max(x0 // TILE_SIZE, 0), max(y0 // TILE_SIZE, 0)
+        tx1 = min((x1 - 1) // TILE_SIZE, (map_size[0] - 1) // TILE_SIZE)
+        ty1 = min((y1 - 1) // TILE_SIZE, (map_size[1] - 1) // TILE_SIZE)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                window.paste(self.get_tile(map_size, tx, ty), (tx * TILE_SIZE - x0, ty * TILE_SIZE - y0))
+
+    def get_tile(self, map_size, tx, ty):
+        key = (self.key, map_size, tx, ty)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        # Scale from the smallest level still not smaller than the required size
+        level_no = 0
+        while level_no + 1 < len(self.levels) \
+                and self.levels[level_no + 1].size[0] >= map_size[0] \
+                and self.levels[level_no + 1].size[1] >= map_size[1]:
+            level_no += 1
+        level = self.levels[level_no]
+        x_ratio = level.size[0] / map_size[0]
+        y_ratio = level.size[1] / map_size[1]
+
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        x1, y1 = min(x0 + TILE_SIZE, map_size[0]), min(y0 + TILE_SIZE, map_size[1])
+        tile = level.resize((x1 - x0, y1 - y0), Image.LANCZOS,
+                            box=(x0 * x_ratio, y0 * y_ratio, x1 * x_ratio, y1 * y_ratio))
+
+        self.tiles[key] = tile
+        if len(self.tiles) > TILE_CACHE_SIZE:
+            self.tiles.popitem(last=False)
+        return tile
+
+
+# A sheet of the catalog. Bounds are (long_min, lat_min, long_max, lat_max), the image is
+# only opened for its size until the sheet is shown
+class MapSheet:
+
+    def __init__(self, file_name, bounds):
+        self.file_name = file_name
+        self.bounds = bounds
+        with Image.open(file_name) as img:
+            self.size = img.size  # only the header is read
+
+    def area_deg(self):
+        long_min, lat_min, long_max, lat_max = self.bounds
+        return (long_max - long_min) * (lat_max - lat_min)
+
+    # Decodes the image reduced by the factor. JPEG sheets are decoded right at the reduced
+    # size with draft(), the rest are decoded whole and reduced. What the reduction leaves
+    # off the size, e.g. of sheets not a multiple of the factor across, is resized
+    def decode(self, reduce):
+        size = (ceil(self.size[0] / reduce), ceil(self.size[1] / reduce))
+        with Image.open(self.file_name) as img:
+            if reduce > 1:
+                img.draft('RGB', size)
+            img = img.convert('RGB')
+        factor = round(min(img.size[0] / size[0], img.size[1] / size[1]))
+        if factor > 1:
+            img = img.reduce(factor)
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        return img
+
+
+# Index grid cells the bounds cover
+def grid_cells(bounds):
+    long_min, lat_min, long_max, lat_max = bounds
+    return ((i, j)
+            for i in range(floor(long_min / MAP_INDEX_CELL_DEG), floor(long_max / MAP_INDEX_CELL_DEG) + 1)
+            for j in range(floor(lat_min / MAP_INDEX_CELL_DEG), floor(lat_max / MAP_INDEX_CELL_DEG) + 1))
+
+
+def grid_cells_num(bounds):
+    long_min, lat_min, long_max, lat_max = bounds
+    return ((floor(long_max / MAP_INDEX_CELL_DEG) - floor(long_min / MAP_INDEX_CELL_DEG) + 1) *
+            (floor(lat_max / MAP_INDEX_CELL_DEG) - floor(lat_min / MAP_INDEX_CELL_DEG) + 1))
+
+
+class MapCatalog:
+
+    def __init__(self):
+        self.sheets = []
+        self.grid = defaultdict(list)  # Numbers of the sheets by index cell
+        self.pyramids = OrderedDict()  # LRU of decoded sheets by (sheet number, reduce factor)
+        self.tiles = OrderedDict()  # LRU cache of scaled tiles of all sheets
+
+    def add(self, sheet):
+        sheet_no = len(self.sheets)
+        self.sheets.append(sheet)
+        for cell in grid_cells(sheet.bounds):
+            self.grid[cell].append(sheet_no)
+
+    # Numbers of the sheets intersecting the bounds, larger ones first, so that more
+    # detailed ones are drawn over them
+    def query(self, bounds):
+        long_min, lat_min, long_max, lat_max = bounds
+        if grid_cells_num(bounds) > len(self.grid):
+            sheet_nos = range(len(self.sheets))  # zoomed out too far for the grid to help
+        else:
+            sheet_nos = set()
+            for cell in grid_cells(bounds):
+                sheet_nos.update(self.grid.get(cell, ()))
+        found = []
+        for sheet_no in sheet_nos:
+            sheet_long_min, sheet_lat_min, sheet_long_max, sheet_lat_max = self.sheets[sheet_no].bounds
+            if sheet_long_min < long_max and sheet_long_max > long_min and \
+                    sheet_lat_min < lat_max and sheet_lat_max > lat_min:
+                found.append(sheet_no)
+        return sorted(found, key=lambda sheet_no: (-self.sheets[sheet_no].area_deg(), sheet_no))
+
+    # Returns the map of size pixels with the lower left corner at the coordinates
+    def render(self, long_min, lat_min, px_per_deg, size):
+        width, height = size
+        window = Image.new('RGB', size, MAP_BG_COLOR)
+        in_view = set()
+        for sheet_no in self.query((long_min, lat_min, long_min + width / px_per_deg,
+                                    lat_min + height / px_per_deg)):
+            sheet = self.sheets[sheet_no]
+            sheet_long_min, sheet_lat_min, sheet_long_max, sheet_lat_max = sheet.bounds
+            map_size = (round((sheet_long_max - sheet_long_min) * px_per_deg),
+                        round((sheet_lat_max - sheet_lat_min) * px_per_deg))
+            if not min(map_size):
+                continue
+            x0 = round((long_min - sheet_long_min) * px_per_deg)
+            y0 = round(map_size[1] - (lat_min - sheet_lat_min) * px_per_deg - height)
+            key = (sheet_no, self.reduce_factor(sheet, map_size))
+            in_view.add(key)
+            self.get_pyramid(key).paste_into(window, map_size, (x0, y0, x0 + width, y0 + height))
+        self.evict(in_view)
+        return window
+
+    # Largest power of two the sheet can be reduced by and still be not smaller than map_size
+    def reduce_factor(self, sheet, map_size):
+        ratio = min(sheet.size[0] / map_size[0], sheet.size[1] / map_size[1])
+        if ratio < 2.0:
+            return 1
+        return min(2 ** floor(log2(ratio)), MAP_MAX_REDUCE)
+
+    def get_pyramid(self, key):
+        pyramid = self.pyramids.get(key)
+        if pyramid is not None:
+            self.pyramids.move_to_end(key)
+            return pyramid
+        sheet_no, reduce = key
+        pyramid = self.pyramids[key] = MapPyramid(self.sheets[sheet_no].decode(reduce), self.tiles, key)
+        return pyramid
+
+    # Drops the least recently shown decoded sheets out of view over the memory budget
+    def evict(self, in_view):
+        decoded_px = sum(pyramid.area() for key, pyramid in self.pyramids.items() if key not in in_view)
+        for key in list(self.pyramids):
+            if decoded_px <= MAP_DECODED_PX:
+                break
+            if key in in_view:
+                continue
+            decoded_px -= self.pyramids.pop(key).area()
+            for tile_key in [tile_key for tile_key in self.tiles if tile_key[0] == key]:
+                del self.tiles[tile_key]
+
+
+# Catalog of the sheets in the directory. Bounds of a sheet are in a JSON file of the same
+# name next to it: {"long_min": ..., "lat_min": ..., "long_max": ..., "lat_max": ...}
+def load_map_catalog(map_dir):
+    catalog = MapCatalog()
+    for file_name in sorted(os.listdir(map_dir)):
+        base_name, ext = os.path.splitext(file_name)
+        bounds_file_name = os.path.join(map_dir, base_name + MAP_BOUNDS_EXT)
+        if ext.lower() not in MAP_SHEET_EXTS or not os.path.exists(bounds_file_name):
+            continue
+        with open(bounds_file_name) as file:
+            bounds = json.load(file)
+        catalog.add(MapSheet(os.path.join(map_dir, file_name),
+                             (bounds['long_min'], bounds['lat_min'], bounds['long_max'], bounds['lat_max'])))
+    return catalog
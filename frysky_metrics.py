@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+HIST_BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))  # Upper bounds of histogram buckets, 1 us .. 8 s
+METRICS_SNAPSHOT_PER = 1.0  # Period of writing metrics snapshots, seconds
+METRICS_HOST = '127.0.0.1'
+
+# Metrics are updated without locks: every metric has a single writer thread, readers may
+# get a snapshot a few updates old. Counters and gauges may also read their value from a
+# function when the snapshot is taken, which costs nothing on the hot path
+
+
+class Counter:
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.func() if self.func else self.value
+
+
+class Gauge:
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.func() if self.func else self.value
+
+
+# Counts of values in buckets with bounds growing twice, values are seconds
+class Histogram:
+
+    def __init__(self, bounds=HIST_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Upper bound of the bucket the quantile falls into
+    def quantile(self, share):
+        rank = share * self.count
+        cumulative = 0
+        for bucket_no, bucket in enumerate(self.buckets):
+            cumulative += bucket
+            if cumulative >= rank and bucket:
+                return min(self.bounds[bucket_no], self.max) if bucket_no < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def get(self, name, metric_class, func):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(func) if func else metric_class()
+        elif func:
+            metric.func = func  # a new source replaces the previous one, e.g. a new parser
+        return metric
+
+    def counter(self, name, func=None):
+        return self.get(name, Counter, func)
+
+    def gauge(self, name, func=None):
+        return self.get(name, Gauge, func)
+
+    def histogram(self, name):
+        return self.get(name, Histogram, None)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+
+# Metrics of one of several sources of the same kind, e.g. links: they are kept in the
+# shared registry under names starting with the prefix
+class MetricsScope(MetricsRegistry):
+
+    def __init__(self, registry, prefix):
+        self.registry = registry
+        self.prefix = prefix
+
+    def get(self, name, metric_class, func):
+        return self.registry.get(self.prefix + name, metric_class, func)
+
+    def snapshot(self):
+        return {name[len(self.prefix):]: val for name, val in self.registry.snapshot().items()
+                if name.startswith(self.prefix)}
+
+
+# Writes snapshots of the metrics to a JSON file once per period. The file is replaced at
+# once, so readers never see it half written
+class MetricsSnapshotWriter(threading.Thread):
+
+    def __init__(self, metrics, file_name, period=METRICS_SNAPSHOT_PER):
+        threading.Thread.__init__(self, daemon=True)
+        self.metrics = metrics
+        self.file_name = file_name
+        self.period = period
+        self.term_sig = False
+
+    def run(self):
+        while not self.term_sig:
+            time.sleep(self.period)
+            self.write()
+
+    def write(self):
+        snapshot = {'time': time.time(), 'metrics': self.metrics.snapshot()}
+        tmp_file_name = self.file_name + '.tmp'
+        with open(tmp_file_name, 'w') as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(tmp_file_name, self.file_name)
+
+
+# Serves snapshots of the metrics as JSON on localhost. Returns the server, its shutdown() stops it
+def serve_metrics(metrics, port):
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = json.dumps({'time': time.time(), 'metrics': metrics.snapshot()}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((METRICS_HOST, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
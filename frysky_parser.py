@@ -1,10 +1,27 @@
 #!/usr/bin/python3
 # coding=UTF-8
 
+from array import array
+from collections import deque, Counter
+from itertools import repeat
+import mmap
+import os
+import re
+import struct
 import threading
 import time
+from frysky_derived import DerivedParams
+from frysky_metrics import MetricsRegistry
 
 INSTREAM_ACQ_PER = 0.1  # Period of data acquisition from the input stream, seconds
+SERIAL_READ_TIMEOUT = 0.1  # Longest wait for data from a serial port, seconds
+PAUSED_FEED_SIZE = 11  # Bytes fed to the decoder at once when a pause between packets is set
+DECODE_CHUNK_SIZE = 1 << 20  # Bytes of a mapped dump file decoded at once
+STREAM_READ_SIZE = 1 << 16  # Bytes read from a file stream at once
+PARAM_RING_CAPACITY = 1000  # Samples kept per parameter until the consumer takes them
+DECODE_TIME_SAMPLING = 8  # Every this chunk read is timed for the decode time histogram
+DUMP_PACKET_RATE = 100  # Telemetry packets per second of dump time (frysky_sim OUT_DATA_RATE)
+TEL_PACK_PAR_NAME = 'vlt'  # Every telemetry packet starts with exactly one sample of it
 
 # State machine variables
 IDLE = -1
@@ -26,123 +43,696 @@ GPS_LONG_AFT_PNT = 0x02
 GPS_LAT_BEF_PNT = 0x04
 GPS_LAT_AFT_PNT = 0x08
 
-prim_to_par = {  # Parameters names by their PRIMs
-    0x12: 'long_bef_pnt',
-    0x1A: 'long_aft_pnt',
-    0x13: 'lat_bef_pnt',
-    0x1B: 'lat_aft_pnt',
-    0x03: 'rot_freq'
+CELL_VLT_NAMES = tuple('cell_vlt_{}'.format(i + 1) for i in range(16))  # Cell voltages by cell number
+
+
+def signed(val):
+    return val - ((val & 0x8000) << 1)
+
+
+# Parameters sent before and after the decimal point as two parts, the sign is in the first one
+def join_point(bef_pnt, aft_pnt):
+    bef_pnt = signed(bef_pnt)
+    return bef_pnt - aft_pnt if bef_pnt < 0 else bef_pnt + aft_pnt
+
+
+def join_cm(bef_pnt, aft_pnt):
+    return join_point(bef_pnt, aft_pnt / 100.0)
+
+
+def join_dm(bef_pnt, aft_pnt):
+    return join_point(bef_pnt, aft_pnt / 10.0)
+
+
+# Date as YYYYMMDD: day and month, then year since 2000
+def join_date(day_month, year):
+    return (2000 + year) * 10000 + (day_month >> 8) * 100 + (day_month & 0xFF)
+
+
+# Time of day as seconds: hour and minute, then second
+def join_time(hour_min, sec):
+    return (hour_min & 0xFF) * 3600 + (hour_min >> 8) * 60 + sec
+
+
+# Sensor hub parameters by their PRIMs: name, decoding method of FrySkyDecoder and its
+# argument. Plain unsigned values have no method. Values come as LSB, MSB
+hub_pars = {
+    0x01: ('gps_alt', 'push_hub_first_part', None),  # m
+    0x09: ('gps_alt', 'push_hub_last_part', join_cm),
+    0x02: ('temp1', 'push_hub_signed', 1),  # deg C
+    0x03: ('rot_freq', None, None),
+    0x04: ('fuel', None, None),  # %
+    0x05: ('temp2', 'push_hub_signed', 1),  # deg C
+    0x06: ('cell_vlt', 'push_hub_cell', None),  # V
+    0x10: ('alt', 'push_hub_first_part', None),  # m
+    0x21: ('alt', 'push_hub_last_part', join_cm),
+    0x11: ('gps_speed', 'push_hub_first_part', None),  # knots
+    0x19: ('gps_speed', 'push_hub_last_part', join_cm),
+    0x12: ('coor', 'push_gps_part', GPS_LONG_BEF_PNT),
+    0x1A: ('coor', 'push_gps_part', GPS_LONG_AFT_PNT),
+    0x13: ('coor', 'push_gps_part', GPS_LAT_BEF_PNT),
+    0x1B: ('coor', 'push_gps_part', GPS_LAT_AFT_PNT),
+    0x22: ('coor', 'push_gps_hemisphere', ord('W')),  # 'E' or 'W'
+    0x23: ('coor', 'push_gps_hemisphere', ord('S')),  # 'N' or 'S'
+    0x14: ('gps_course', 'push_hub_first_part', None),  # deg
+    0x1C: ('gps_course', 'push_hub_last_part', join_cm),
+    0x15: ('gps_date', 'push_hub_first_part', None),
+    0x16: ('gps_date', 'push_hub_last_part', join_date),
+    0x17: ('gps_time', 'push_hub_first_part', None),
+    0x18: ('gps_time', 'push_hub_last_part', join_time),
+    0x24: ('acc_x', 'push_hub_signed', 0.001),  # g
+    0x25: ('acc_y', 'push_hub_signed', 0.001),
+    0x26: ('acc_z', 'push_hub_signed', 0.001),
+    0x28: ('hub_cur', 'push_hub_scaled', 0.1),  # A
+    0x30: ('vert_speed', 'push_hub_signed', 0.01),  # m/s
+    0x3A: ('hub_vlt', 'push_hub_first_part', None),  # V
+    0x3B: ('hub_vlt', 'push_hub_last_part', join_dm)
+}
+
+# Methods whose parameters are put together from several packets
+HUB_PART_METHODS = frozenset(('push_hub_first_part', 'push_hub_last_part', 'push_gps_part', 'push_gps_hemisphere'))
+
+
+# 256 entries by PRIM: (name, decoding function, argument), None for unknown PRIMs
+def hub_dispatch_table(decoder_class):
+    table = [None] * 256
+    for prim, (par_name, method_name, arg) in hub_pars.items():
+        table[prim] = (par_name, getattr(decoder_class, method_name) if method_name else None, arg)
+    return tuple(table)
+
+
+# Well-formed packets. Stuffed bytes are allowed in the payload only, anything else is left
+# to the byte-wise state machine
+FRAME_RE = re.compile(
+    rb'(\x7E\xFE(?:[^\x7D]|\x7D+[^\x7D]){3}[^\x7D\x7E]{0,5}\x7E'
+    rb'|\x5E(?:[^\x5D]|\x5D+[^\x5D]){3}[^\x5D\x5E]{0,6}\x5E)')
+FRAME_START_RE = re.compile(rb'[\x7E\x5E]')
+FRAME_SIZE = 11  # Bytes of a packet without stuffed bytes
+# Runs of packets of FRAME_SIZE without stuffed bytes, as nearly all packets are
+RUN_RE = re.compile(rb'(?:(?>\x7E\xFE[^\x7D\x7E]{8}\x7E|\x5E[^\x5D\x5E]{9}\x5E))+')
+RUN_WINDOW = 1 << 16  # Bytes of a run decoded at once
+FRAME_HEAD = struct.Struct('5B6x')  # Start byte and the value bytes of a packet of a run
+CUT_PACKET_MAX = 2 * FRAME_SIZE  # Bytes of a packet cut by the chunk end kept for the next chunk at most
+
+TEL_UNSTUFF_TABLE = bytes(i ^ 0x20 for i in range(256))
+HUB_UNSTUFF_TABLE = bytes(i ^ 0x60 for i in range(256))
+
+# Telemetry records by byte value
+VLT_RECORDS = tuple(('vlt', 4.2 * (i / 256.0)) for i in range(256))
+CUR_RECORDS = tuple(('cur', 100.0 * (i / 256.0)) for i in range(256))
+SIG_LEV_RECORDS = tuple(('sig_lev', i) for i in range(256))
+
+
+def unstuff(data, spec_byte, table):
+    parts = data.split(spec_byte)
+    return parts[0] + b''.join(part[:1].translate(table) + part[1:] for part in parts[1:])
+
+
+class FrySkyDecoder:
+
+    def __init__(self):
+        self.state = IDLE
+        self.pack_cntr = 0
+        self.is_spec_byte_met = False
+        self.hub_prim = 0
+        self.par_lsb_byte = 0
+        self.gps_flags = 0x00
+        self.gps_parts = {}  # Parts of the coordinates by their flags
+        self.gps_signs = {ord('W'): 1, ord('S'): 1}
+        self.hub_first_parts = {}  # First parts of two-part parameters by their names
+        # Names of the plain unsigned hub parameters by PRIM, None for the rest
+        self.hub_names = tuple(hub_par[0] if hub_par is not None and hub_par[1] is None else None
+                               for hub_par in self.hub_dispatch)
+        self.frames_cntr = 0  # Packets closed by their end byte
+        self.dropped_frames_cntr = 0  # Packets dropped for being longer than 11 bytes
+        self.unknown_hub_ids_cntr = 0  # Hub packets skipped for unknown PRIMs
+        self.bytes_cntr = 0  # Bytes fed so far
+        self.pack_start = 0  # Stream offset of the current packet
+        self.cut_packet = b''  # End of the previous chunk, a packet cut by it, decoded with the next chunk
+
+    # Decodes next chunk of the input stream, returns list of (par_name, par_val) records.
+    # If offsets list is given, stream offset of the packet is appended to it for every record.
+    # A packet cut by the chunk end is decoded with the next chunk, or by flush()
+    def feed(self, buffer, offsets=None):
+        records = []
+        if self.cut_packet:
+            buffer = self.cut_packet + buffer
+            self.bytes_cntr -= len(self.cut_packet)
+            self.cut_packet = b''
+        pos = 0
+        buf_len = len(buffer)
+        while pos < buf_len:
+            if self.state != IDLE:
+                pos = self.decode_bytes(buffer, pos, records, offsets)
+                continue
+            match = RUN_RE.match(buffer, pos, pos + RUN_WINDOW)
+            if match is not None:
+                end = match.end()
+                if offsets is not None:
+                    self.decode_run(buffer[pos:end], records, offsets, self.bytes_cntr + pos)
+                else:  # same as decode_run(), small chunks are mostly fed without offsets
+                    vlt_records, cur_records, sig_lev_records = VLT_RECORDS, CUR_RECORDS, SIG_LEV_RECORDS
+                    hub_names = self.hub_names
+                    for start, prim, b2, b3, b4 in FRAME_HEAD.iter_unpack(buffer[pos:end]):
+                        if start == 0x7E:
+                            records += (vlt_records[b2], cur_records[b3], sig_lev_records[b4])
+                        else:
+                            par_name = hub_names[prim]
+                            if par_name is not None:
+                                records.append((par_name, b3 * 256 + b2))
+                            else:
+                                self.push_hub_param(prim, b2, b3, records)
+                    self.frames_cntr += (end - pos) // FRAME_SIZE
+                pos = end
+                if buf_len - pos < FRAME_SIZE:
+                    if pos < buf_len:
+                        self.cut_packet = bytes(buffer[pos:])
+                    break
+                continue
+            if buf_len - pos < FRAME_SIZE:
+                self.cut_packet = bytes(buffer[pos:])
+                break
+            # Bytes between packets are ignored in idle state
+            match = FRAME_RE.match(buffer, pos)
+            if match is not None:
+                self.decode_frames((match.group(),), records)
+                self.frames_cntr += 1
+                if offsets is not None:
+                    offsets += [self.bytes_cntr + pos] * (len(records) - len(offsets))
+                pos = match.end()
+            elif buffer[pos] == 0x7E or buffer[pos] == 0x5E:
+                if buf_len - pos < CUT_PACKET_MAX:
+                    self.cut_packet = bytes(buffer[pos:])
+                    break
+                pos = self.decode_bytes(buffer, pos, records, offsets)  # a broken packet
+            else:
+                start = FRAME_START_RE.search(buffer, pos)
+                pos = start.start() if start else buf_len
+        self.bytes_cntr += buf_len
+        return records
+
+    # Decodes the packet cut by the end of the last chunk as it is, e.g. at the end of the
+    # stream. Returns records as feed() does, offsets are appended to the list given
+    def flush(self, offsets=None):
+        records = []
+        pack_offsets = [] if offsets is not None else None
+        cut_packet, self.cut_packet = self.cut_packet, b''
+        self.bytes_cntr -= len(cut_packet)
+        pos = 0
+        while pos < len(cut_packet):
+            pos = self.decode_bytes(cut_packet, pos, records, pack_offsets)
+        self.bytes_cntr += len(cut_packet)
+        if offsets is not None:
+            offsets += pack_offsets
+        return records
+
+    # Decodes a run of packets found by RUN_RE starting at the stream offset run_start.
+    # Values are taken right from the packet heads
+    def decode_run(self, run, records, offsets=None, run_start=0):
+        vlt_records, cur_records, sig_lev_records = VLT_RECORDS, CUR_RECORDS, SIG_LEV_RECORDS
+        hub_names = self.hub_names
+        for start, prim, b2, b3, b4 in FRAME_HEAD.iter_unpack(run):
+            if start == 0x7E:
+                records += (vlt_records[b2], cur_records[b3], sig_lev_records[b4])
+            else:
+                par_name = hub_names[prim]
+                if par_name is not None:
+                    records.append((par_name, b3 * 256 + b2))
+                else:
+                    self.push_hub_param(prim, b2, b3, records)
+            if offsets is not None:
+                offsets += [run_start] * (len(records) - len(offsets))
+                run_start += FRAME_SIZE
+        self.frames_cntr += len(run) // FRAME_SIZE
+
+    # Decodes well-formed packets found by FRAME_RE
+    def decode_frames(self, frames, records):
+        append = records.append
+        vlt_records, cur_records, sig_lev_records = VLT_RECORDS, CUR_RECORDS, SIG_LEV_RECORDS
+        hub_dispatch = self.hub_dispatch
+        for frame in frames:
+            if frame[0] == 0x7E:
+                if 0x7D in frame:
+                    frame = unstuff(frame, b'\x7D', TEL_UNSTUFF_TABLE)
+                records += (vlt_records[frame[2]], cur_records[frame[3]], sig_lev_records[frame[4]])
+            else:
+                if 0x5D in frame:
+                    frame = unstuff(frame, b'\x5D', HUB_UNSTUFF_TABLE)
+                hub_par = hub_dispatch[frame[1]]
+                if hub_par is None:
+                    self.unknown_hub_ids_cntr += 1
+                elif hub_par[1] is None:
+                    append((hub_par[0], frame[3] * 256 + frame[2]))
+                else:
+                    hub_par[1](self, hub_par[0], hub_par[2], frame[3] * 256 + frame[2], records)
+
+    def push_hub_param(self, prim, par_lsb_byte, par_msb_byte, records):
+        hub_par = self.hub_dispatch[prim]
+        if hub_par is None:
+            self.unknown_hub_ids_cntr += 1
+        elif hub_par[1] is None:
+            records.append((hub_par[0], par_msb_byte * 256 + par_lsb_byte))
+        else:
+            hub_par[1](self, hub_par[0], hub_par[2], par_msb_byte * 256 + par_lsb_byte, records)
+
+    def push_hub_signed(self, par_name, scale, val, records):
+        records.append((par_name, signed(val) * scale))
+
+    def push_hub_scaled(self, par_name, scale, val, records):
+        records.append((par_name, val * scale))
+
+    # Cell number in the high nibble of the LSB, voltage in 2 mV in the rest, MSB of it first
+    def push_hub_cell(self, par_name, arg, val, records):
+        records.append((CELL_VLT_NAMES[(val >> 4) & 0x0F], (((val & 0x0F) << 8) | (val >> 8)) / 500.0))
+
+    def push_hub_first_part(self, par_name, arg, val, records):
+        self.hub_first_parts[par_name] = val
+
+    # The parameter is put together once its first part has come
+    def push_hub_last_part(self, par_name, join, val, records):
+        first_part = self.hub_first_parts.pop(par_name, None)
+        if first_part is not None:
+            records.append((par_name, join(first_part, val)))
+
+    def push_gps_hemisphere(self, par_name, negative, val, records):
+        self.gps_signs[negative] = -1 if val & 0xFF == negative else 1
+
+    def push_gps_part(self, par_name, part_flag, val, records):
+        self.gps_flags |= part_flag
+        self.gps_parts[part_flag] = val
+
+        # GPS processing
+        if self.gps_flags == (GPS_LONG_BEF_PNT | GPS_LONG_AFT_PNT | GPS_LAT_BEF_PNT | GPS_LAT_AFT_PNT):
+            gps_parts = self.gps_parts
+            # Longitude, degrees and minutes before the point
+            long_deg = gps_parts[GPS_LONG_BEF_PNT] // 100
+            long_min = (gps_parts[GPS_LONG_BEF_PNT] - long_deg * 100.0) + (gps_parts[GPS_LONG_AFT_PNT] / 1000.0)
+            long = self.gps_signs[ord('W')] * (long_deg + (long_min / 60.0))
+            # Latitude
+            lat_deg = gps_parts[GPS_LAT_BEF_PNT] // 100
+            lat_min = (gps_parts[GPS_LAT_BEF_PNT] - lat_deg * 100.0) + (gps_parts[GPS_LAT_AFT_PNT] / 1000.0)
+            lat = self.gps_signs[ord('S')] * (lat_deg + (lat_min / 60.0))
+            records.append((par_name, (long, lat)))
+            self.gps_flags &= ~(GPS_LONG_BEF_PNT | GPS_LONG_AFT_PNT | GPS_LAT_BEF_PNT | GPS_LAT_AFT_PNT)
+
+    # Byte-wise state machine, runs until the current packet is over. Returns position of the next byte
+    def decode_bytes(self, buffer, pos, records, offsets=None):
+        state = self.state
+        pack_cntr = self.pack_cntr
+        is_spec_byte_met = self.is_spec_byte_met
+        was_active = state != IDLE
+
+        buf_len = len(buffer)
+        while pos < buf_len:
+            cur_byte = buffer[pos]
+            pos += 1
+
+            if (cur_byte == 0x7D and TEL_PACK_START <= state <= TEL_PACK_SIG_LEV)\
+                    or (cur_byte == 0x5D and HUB_PACK_START <= state <= HUB_PAR_MSB):
+                is_spec_byte_met = True
+                continue
+
+            if TEL_PACK_START <= state <= TEL_PACK_SIG_LEV\
+                    and is_spec_byte_met:
+                cur_byte = cur_byte ^ 0x20
+                is_spec_byte_met = False
+            elif HUB_PACK_START <= state <= HUB_PAR_MSB\
+                    and is_spec_byte_met:
+                cur_byte = cur_byte ^ 0x60
+                is_spec_byte_met = False
+
+            pack_cntr += 1
+
+            # Reset if more than 11 bytes. There are no packets longer than 11
+            if pack_cntr >= 11:
+                if state != IDLE:
+                    self.dropped_frames_cntr += 1
+                state = IDLE
+
+            # Telemetry parsing
+            if cur_byte == 0x7E and state == IDLE:
+                state = TEL_PACK_START
+                pack_cntr = 0
+                if offsets is not None:
+                    offsets += [self.pack_start] * (len(records) - len(offsets))
+                    self.pack_start = self.bytes_cntr + pos - 1
+            elif state == TEL_PACK_START and cur_byte == 0xFE:
+                state = TEL_PACK
+            elif state == TEL_PACK:
+                records.append(('vlt', 4.2 * (cur_byte / 256.0)))
+                state = TEL_PACK_VLT
+            elif state == TEL_PACK_VLT:
+                records.append(('cur', 100.0 * (cur_byte / 256.0)))
+                state = TEL_PACK_CUR
+            elif state == TEL_PACK_CUR:
+                records.append(('sig_lev', cur_byte))
+                state = TEL_PACK_SIG_LEV
+            elif state == TEL_PACK_SIG_LEV and cur_byte == 0x7E:
+                state = IDLE
+                self.frames_cntr += 1
+
+            # Sensor hub parsing
+            if cur_byte == 0x5E and state == IDLE:
+                state = HUB_PACK_START
+                pack_cntr = 0
+                if offsets is not None:
+                    offsets += [self.pack_start] * (len(records) - len(offsets))
+                    self.pack_start = self.bytes_cntr + pos - 1
+            elif state == HUB_PACK_START:
+                self.hub_prim = cur_byte
+                state = HUB_PRIM
+            elif state == HUB_PRIM:
+                self.par_lsb_byte = cur_byte
+                state = HUB_PAR_LSB
+            elif state == HUB_PAR_LSB:
+                self.push_hub_param(self.hub_prim, self.par_lsb_byte, cur_byte, records)
+                state = HUB_PAR_MSB
+            elif state == HUB_PAR_MSB and cur_byte == 0x5E:
+                state = IDLE
+                self.frames_cntr += 1
+
+            if state == IDLE:
+                if was_active:
+                    break
+            else:
+                was_active = True
+
+        self.state = state
+        self.pack_cntr = pack_cntr
+        self.is_spec_byte_met = is_spec_byte_met
+        if offsets is not None:
+            offsets += [self.pack_start] * (len(records) - len(offsets))
+        return pos
+
+
+FrySkyDecoder.hub_dispatch = hub_dispatch_table(FrySkyDecoder)
+
+
+# Columns typecodes of decoded parameters, as narrow as the values still fit in: voltage
+# and current are fractions of a byte, the signal level is a byte, hub parameters without
+# a decoding method are 16 bits wide. Other parameters are stored as doubles
+COLUMN_TYPECODES = {
+    'vlt': 'f',
+    'cur': 'f',
+    'sig_lev': 'B',
+    'rot_freq': 'H',
+    'fuel': 'H'
 }
 
 
+# Offsets of dumps under 4 GiB are stored in 4 bytes
+def offsets_typecode(dump_size):
+    return 'I' if dump_size <= 0xFFFFFFFF else 'Q'
+
+
+def new_column(par_name, offset_typecode):
+    if par_name == 'coor':
+        return {'offset': array(offset_typecode), 'long': array('d'), 'lat': array('d')}
+    return {'offset': array(offset_typecode), 'val': array(COLUMN_TYPECODES.get(par_name, 'd'))}
+
+
+# Columns of a dump of the size, see decode_file()
+def new_columns(dump_size):
+    offset_typecode = offsets_typecode(dump_size)
+    return {par_name: new_column(par_name, offset_typecode)
+            for par_name in ('vlt', 'cur', 'sig_lev', 'rot_freq', 'coor')}
+
+
+# Columns of parameters met first have offsets of the type of those of new_columns()
+def append_records(columns, records, offsets):
+    for (par_name, par_val), offset in zip(records, offsets):
+        column = columns.get(par_name)
+        if column is None:
+            column = columns[par_name] = new_column(par_name, columns['vlt']['offset'].typecode)
+        column['offset'].append(offset)
+        if par_name == 'coor':
+            column['long'].append(par_val[0])
+            column['lat'].append(par_val[1])
+        else:
+            column['val'].append(par_val)
+
+
+# Decodes a whole dump file without pauses. Returns columns of every parameter met:
+# {'vlt': {'offset': array, 'val': array}, ..., 'coor': {'offset': array, 'long': array, 'lat': array}},
+# where offset is the dump file offset of the packet the sample came from. Columns are
+# typed as COLUMN_TYPECODES, offsets take 4 bytes in dumps under 4 GiB, so the columns
+# take about 1.2 times the dump size
+def decode_file(path, chunk_size=DECODE_CHUNK_SIZE):
+    decoder = FrySkyDecoder()
+    with open(path, 'rb') as dump_file:
+        dump_size = os.fstat(dump_file.fileno()).st_size
+        columns = new_columns(dump_size)
+        if not dump_size:
+            return columns
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+            for chunk_start in range(0, dump_size, chunk_size):
+                offsets = []
+                records = decoder.feed(dump[chunk_start:chunk_start + chunk_size], offsets)
+                if chunk_start + chunk_size >= dump_size:
+                    records += decoder.flush(offsets)  # the packet cut by the end of the dump
+                append_records(columns, records, offsets)
+    return columns
+
+
+# Time of decoded records. Records of live links are of the time they arrived at. Dumps
+# have no arrival times, their time is counted in telemetry packets, packet_rate of them
+# a second. Kept by the derived parameters, the telemetry history, the replay and the dump
+# index
+class PacketClock:
+
+    def __init__(self, packet_rate=DUMP_PACKET_RATE, start_time=0.0):
+        self.packet_rate = packet_rate
+        self.time = start_time  # Of the latest records, seconds
+
+    # Returns times of the records, which arrived at the time given, or, if it isn't, are of
+    # the telemetry packets following the previous ones. The clock goes on to the latest
+    def times(self, records, arrival_time=None):
+        if arrival_time is not None:
+            self.time = arrival_time
+            return repeat(arrival_time, len(records))
+        times = []
+        t, start_time, packet_rate, packs_num = self.time, self.time, self.packet_rate, 0
+        for par_name, par_val in records:
+            if par_name == TEL_PACK_PAR_NAME:
+                packs_num += 1
+                t = start_time + packs_num / packet_rate
+            times.append(t)
+        self.time = t
+        return times
+
+    # Time of the telemetry packet by its number, counted from the start of the dump
+    def packet_time(self, packet_no):
+        return packet_no / self.packet_rate
+
+    # Number of the telemetry packet of the time, see packet_time()
+    def packet_no(self, t):
+        return int(t * self.packet_rate)
+
+
+# Hand-off of decoded parameters from the parser thread to the consumer. Latest values are
+# kept for a consumer showing only the last value. Every sample is kept only for parameters
+# a consumer has subscribed to, each in a ring of PARAM_RING_CAPACITY samples. When a ring
+# is full the oldest sample is dropped and counted. Coordinates are never dropped
+class ParamsBuffer:
+
+    def __init__(self, capacity=PARAM_RING_CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.rings = {}  # Of the subscribed parameters
+        self.coors = []
+        self.latest = {}
+        self.pushed_cntrs = Counter()  # Of the subscribed parameters
+        self.taken_cntrs = Counter()
+        self.history = None  # TelemetryHistory of frysky_history all records are fed to, if set
+
+    # Records come with their arrival time on live links, see PacketClock.times()
+    def push(self, records, arrival_time=None):
+        if not records:
+            return
+        with self.lock:
+            self.latest.update(records)
+            rings = self.rings
+            for par_name, par_val in records:
+                if par_name == 'coor':
+                    self.coors.append(par_val)
+                    continue
+                ring = rings.get(par_name)
+                if ring is not None:
+                    ring.append(par_val)
+                    self.pushed_cntrs[par_name] += 1
+        if self.history is not None:
+            self.history.feed(records, arrival_time)  # has a lock of its own, takes by the UI don't wait for it
+
+    # Returns {par_name: par_val} of parameters updated since the previous call
+    def take_latest(self):
+        with self.lock:
+            latest = self.latest
+            self.latest = {}
+        return latest
+
+    # Returns all coordinates received since the previous call
+    def take_coors(self):
+        with self.lock:
+            coors = self.coors
+            self.coors = []
+        return coors
+
+    # Keeps every sample of the parameters from now on, see take_samples()
+    def subscribe(self, *par_names):
+        with self.lock:
+            for par_name in par_names:
+                if par_name not in self.rings:
+                    self.rings[par_name] = deque(maxlen=self.capacity)
+
+    # Returns samples of the subscribed parameter received since the previous call, oldest first
+    def take_samples(self, par_name):
+        with self.lock:
+            ring = self.rings.get(par_name)
+            if not ring:
+                return []
+            samples = list(ring)
+            ring.clear()
+            self.taken_cntrs[par_name] += len(samples)
+        return samples
+
+    # Number of samples of the parameter dropped because its ring was full
+    def drops(self, par_name):
+        with self.lock:
+            ring = self.rings.get(par_name)
+            return self.pushed_cntrs[par_name] - self.taken_cntrs[par_name] - (len(ring) if ring else 0)
+
+    def total_drops(self):
+        return sum(self.drops(par_name) for par_name in list(self.rings))
+
+    # Number of samples and coordinates waiting for the consumer
+    def depth(self):
+        with self.lock:
+            return sum(map(len, self.rings.values())) + len(self.coors)
+
+
 class FrySkyParserThread(threading.Thread):
 
-    def __init__(self, input_stream):
+    def __init__(self, input_stream, recorder=None, metrics=None):
         threading.Thread.__init__(self)
         self.input_stream = input_stream
-        self.lock = threading.Lock()
-        self.out_params = []
+        self.recorder = recorder  # Gets a copy of everything read, see frysky_record
+        self.decoder = FrySkyDecoder()
+        self.params = ParamsBuffer()
+        self.derived = DerivedParams(PacketClock())
         self.term_sig = False
         self.pause_s = 0.0
+        self.chunks_cntr = 0  # Chunks read from the input stream
+        self.read_buf = None  # Chunks of file streams are read into it, allocated on the first read
+        self.port_chunks = deque()  # (arrival time, chunk) read by read_port(), see poll()
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.metrics.counter('parser.chunks', lambda: self.chunks_cntr)
+        self.metrics.counter('parser.bytes', lambda: self.decoder.bytes_cntr)
+        self.metrics.counter('parser.frames', lambda: self.decoder.frames_cntr)
+        self.metrics.counter('parser.dropped_frames', lambda: self.decoder.dropped_frames_cntr)
+        self.metrics.counter('parser.unknown_hub_ids', lambda: self.decoder.unknown_hub_ids_cntr)
+        self.metrics.counter('params.dropped', self.params.total_drops)
+        self.metrics.gauge('params.depth', self.params.depth)
+        self.decode_time = self.metrics.histogram('parser.decode_time')
 
     def set_pause(self, new_val_ms):
         self.pause_s = new_val_ms * 1e-3
 
-    def run(self):
-        state = IDLE
-        gps_flags = 0x00
-        pack_cntr = 0
-        is_spec_byte_met = False
+    # Publishes decoded records along with the parameters derived from them. Records read
+    # from a serial port come with their arrival time, see PacketClock.times()
+    def publish(self, records, arrival_time=None):
+        records += self.derived.feed(records, arrival_time)
+        self.params.push(records, arrival_time)
+
+    # Serial ports are waited on until a byte arrives or the port timeout expires, then
+    # everything already received is taken at once. Other streams are polled, a chunk of
+    # them is a view of the read buffer valid until the next read
+    def read_chunk(self):
+        if self.reads_port():
+            chunk = self.input_stream.read(1)
+            if chunk:
+                in_waiting = self.input_stream.in_waiting
+                if in_waiting:
+                    chunk += self.input_stream.read(in_waiting)
+            return chunk
+        chunk = self.read_stream()
+        if not chunk:
+            time.sleep(INSTREAM_ACQ_PER)
+            return b''
+        return chunk
+
+    def reads_port(self):
+        return hasattr(self.input_stream, 'in_waiting')
+
+    # Reads what a file stream has into the read buffer without waiting. Returns a view of
+    # it, empty if there is nothing new
+    def read_stream(self):
+        if self.read_buf is None:
+            self.read_buf = memoryview(bytearray(STREAM_READ_SIZE))
+        return self.read_buf[:self.input_stream.readinto(self.read_buf)]
+
+    # Waits on the serial port and queues the chunks for poll(), calls on_chunk after every
+    # one. Runs in a thread of its own when the parser is stepped by a worker pool, so the
+    # workers only decode and an idle port costs no polling
+    def read_port(self, on_chunk):
+        while not self.term_sig:
+            chunk = self.read_chunk()
+            if chunk:
+                self.port_chunks.append((time.monotonic(), chunk))
+                on_chunk()
 
+    # One step for a worker pool, see frysky_link: decodes what has already been received
+    # without waiting for more. Returns the delay before the next step, seconds, or None if
+    # the next step waits for a chunk from read_port()
+    def poll(self):
+        if self.reads_port():
+            port_chunks = self.port_chunks
+            while port_chunks and not self.term_sig:
+                arrival_time, chunk = port_chunks.popleft()
+                self.process_chunk(chunk, arrival_time)
+            return None
+        chunk = self.read_stream()
+        if not chunk:
+            self.flush_decoder()
+            return INSTREAM_ACQ_PER
+        self.process_chunk(chunk)
+        return 0.0
+
+    def process_chunk(self, chunk, arrival_time=None):
+        if self.recorder:
+            self.recorder.record(bytes(chunk), arrival_time)  # queued, so a view of the read buffer is copied
+        if not self.pause_s:
+            if self.chunks_cntr % DECODE_TIME_SAMPLING:
+                self.publish(self.decoder.feed(chunk), arrival_time)
+            else:
+                decode_start = time.perf_counter()
+                self.publish(self.decoder.feed(chunk), arrival_time)
+                self.decode_time.observe(time.perf_counter() - decode_start)
+            self.chunks_cntr += 1
+        else:
+            # Feed packet by packet to keep the pause after each one
+            for i in range(0, len(chunk), PAUSED_FEED_SIZE):
+                if self.term_sig:
+                    break
+                frames_cntr = self.decoder.frames_cntr
+                self.publish(self.decoder.feed(chunk[i:i + PAUSED_FEED_SIZE]), arrival_time)
+                time.sleep(self.pause_s * (self.decoder.frames_cntr - frames_cntr))
+
+    # Publishes the packet the decoder keeps cut by the end of the last chunk once nothing more
+    # has come, e.g. at the end of a dump
+    def flush_decoder(self, arrival_time=None):
+        records = self.decoder.flush()
+        if records:
+            self.publish(records, arrival_time)
+
+    def run(self):
         while not self.term_sig:
-            chunk = self.input_stream.read()
+            chunk = self.read_chunk()
             if chunk == b'':
-                time.sleep(INSTREAM_ACQ_PER)
-            for cur_byte in chunk:
-                if (cur_byte == 0x7D and TEL_PACK_START <= state <= TEL_PACK_SIG_LEV)\
-                        or (cur_byte == 0x5D and HUB_PACK_START <= state <= HUB_PAR_MSB):
-                    is_spec_byte_met = True
-                    continue
+                self.flush_decoder(time.monotonic() if self.reads_port() else None)
+                continue
+            self.process_chunk(chunk, time.monotonic() if self.reads_port() else None)
+
 
-                if TEL_PACK_START <= state <= TEL_PACK_SIG_LEV\
-                        and is_spec_byte_met:
-                    cur_byte = cur_byte ^ 0x20
-                    is_spec_byte_met = False
-                elif HUB_PACK_START <= state <= HUB_PAR_MSB\
-                        and is_spec_byte_met:
-                    cur_byte = cur_byte ^ 0x60
-                    is_spec_byte_met = False
-
-                pack_cntr += 1
-
-                # Reset if more than 11 bytes. There are no packets longer than 11
-                if pack_cntr >= 11:
-                    state = IDLE
-
-                # Telemetry parsing
-                if cur_byte == 0x7E and state == IDLE:
-                    state = TEL_PACK_START
-                    pack_cntr = 0
-                elif state == TEL_PACK_START and cur_byte == 0xFE:
-                    state = TEL_PACK
-                elif state == TEL_PACK:
-                    self.push_param('vlt', 4.2 * (cur_byte / 256.0))
-                    state = TEL_PACK_VLT
-                elif state == TEL_PACK_VLT:
-                    self.push_param('cur', 100.0 * (cur_byte / 256.0))
-                    state = TEL_PACK_CUR
-                elif state == TEL_PACK_CUR:
-                    self.push_param('sig_lev', cur_byte)
-                    state = TEL_PACK_SIG_LEV
-                elif state == TEL_PACK_SIG_LEV and cur_byte == 0x7E:
-                    state = IDLE
-                    time.sleep(self.pause_s)
-
-                # Sensor hub parsing
-                if cur_byte == 0x5E and state == IDLE:
-                    state = HUB_PACK_START
-                    pack_cntr = 0
-                elif state == HUB_PACK_START:
-                    par_name = prim_to_par[cur_byte]
-                    state = HUB_PRIM
-                elif state == HUB_PRIM:
-                    par_lsb_byte = cur_byte
-                    state = HUB_PAR_LSB
-                elif state == HUB_PAR_LSB:
-                    par_msb_byte = cur_byte
-                    if par_name == 'long_bef_pnt':
-                        gps_flags |= GPS_LONG_BEF_PNT
-                        gps_long_bef_pnt = par_msb_byte * 256 + par_lsb_byte
-                    elif par_name == 'long_aft_pnt':
-                        gps_flags |= GPS_LONG_AFT_PNT
-                        gps_long_aft_pnt = par_msb_byte * 256 + par_lsb_byte
-                    elif par_name == 'lat_bef_pnt':
-                        gps_flags |= GPS_LAT_BEF_PNT
-                        gps_lat_bef_pnt = par_msb_byte * 256 + par_lsb_byte
-                    elif par_name == 'lat_aft_pnt':
-                        gps_flags |= GPS_LAT_AFT_PNT
-                        gps_lat_aft_pnt = par_msb_byte * 256 + par_lsb_byte
-                    else:
-                        self.push_param(par_name, par_msb_byte * 256 + par_lsb_byte)
-                    state = HUB_PAR_MSB
-                elif state == HUB_PAR_MSB and cur_byte == 0x5E:
-                    state = IDLE
-                    time.sleep(self.pause_s)
-
-                # GPS processing
-                if gps_flags == (GPS_LONG_BEF_PNT | GPS_LONG_AFT_PNT | GPS_LAT_BEF_PNT | GPS_LAT_AFT_PNT):
-                    # Longitude
-                    long_deg = gps_long_bef_pnt // 100
-                    long_min = (gps_long_bef_pnt - long_deg * 100.0) + (gps_long_aft_pnt / 1000.0)
-                    long = long_deg + (long_min / 60.0)
-                    # Latitude
-                    lat_deg = gps_lat_bef_pnt // 100
-                    lat_min = (gps_lat_bef_pnt - lat_deg * 100.0) + (gps_lat_aft_pnt / 1000.0)
-                    lat = lat_deg + (lat_min / 60.0)
-                    self.push_param('coor', (long, lat))
-                    gps_flags &= ~(GPS_LONG_BEF_PNT | GPS_LONG_AFT_PNT | GPS_LAT_BEF_PNT | GPS_LAT_AFT_PNT)
-
-    def push_param(self, par_name, par_val):
-        self.lock.acquire(blocking=1)
-        self.out_params.append((par_name, par_val))
-        self.lock.release()
\ No newline at end of file
+if __name__ == '__main__':
+    import frysky_convert
+    frysky_convert.main()
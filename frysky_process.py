@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+# Decoding in a child process, so it doesn't compete with the UI for the GIL. The child
+# reads the serial port with FrySkyParserThread and writes decoded records to a ring in
+# shared memory, a thread of the UI process takes them into a ParamsBuffer
+
+from array import array
+from multiprocessing import Process
+from multiprocessing.shared_memory import SharedMemory
+import struct
+import threading
+import time
+import serial
+from frysky_derived import DERIVED_PAR_NAMES
+from frysky_metrics import MetricsRegistry, HIST_BOUNDS
+from frysky_parser import FrySkyParserThread, ParamsBuffer, SERIAL_READ_TIMEOUT, CELL_VLT_NAMES, hub_pars
+from frysky_record import FrySkyRecorder
+
+RING_CAPACITY = 1 << 16  # Records in the ring
+RING_POLL_PER = 0.01  # Period of taking records from the ring, seconds
+RING_FULL_WAIT = 0.001  # Wait of the child for free room in the ring, seconds
+PUBLISH_PER = 0.1  # Period of publishing the child counters and reading the pause, seconds
+PROCESS_START_TIMEOUT = 5.0  # Longest wait for the child to open the port, seconds
+
+# Records are the parameter number in PAR_NAMES, the value kind and two doubles
+RECORD = struct.Struct('<HB5xdd')
+FLOAT_VAL = 0
+INT_VAL = 1
+PAIR_VAL = 2  # coordinates
+
+PAR_NAMES = tuple(dict.fromkeys(('vlt', 'cur', 'sig_lev', 'coor') +
+                                tuple(par_name for par_name, method_name, arg in hub_pars.values()
+                                      if method_name != 'push_hub_cell') +
+                                CELL_VLT_NAMES + DERIVED_PAR_NAMES))
+par_nums = {par_name: par_num for par_num, par_name in enumerate(PAR_NAMES)}
+
+# Header slots, 8 bytes each. Every slot has a single writer: the positions of the ring
+# are written by their sides, the rest but the term flag and the pause by the child
+WRITE_POS = 0  # Records written so far
+READ_POS = 1  # Records taken so far
+STATE = 2
+TERM = 3  # Set by the parent to stop the child
+PAUSE = 4  # Pause after each packet, seconds, double
+CHUNKS = 5
+BYTES = 6
+FRAMES = 7
+DROPPED_FRAMES = 8
+UNKNOWN_HUB_IDS = 9
+DECODE_COUNT = 10
+DECODE_SUM = 11  # double
+DECODE_MAX = 12  # double
+DECODE_BUCKETS = 13
+HEADER_SLOTS = DECODE_BUCKETS + len(HIST_BOUNDS) + 1
+
+# Counters published by the child: metric name, header slot
+PUBLISHED_COUNTERS = (
+    ('parser.chunks', CHUNKS),
+    ('parser.bytes', BYTES),
+    ('parser.frames', FRAMES),
+    ('parser.dropped_frames', DROPPED_FRAMES),
+    ('parser.unknown_hub_ids', UNKNOWN_HUB_IDS)
+)
+
+# Child states
+STARTING = 0
+RUNNING = 1
+PORT_FAILED = 2
+RECORD_FAILED = 3
+
+
+def ring_size(capacity=RING_CAPACITY):
+    return HEADER_SLOTS * 8 + capacity * RECORD.size
+
+
+# Records ring in shared memory, single writer and single reader. Slots are aligned 8 byte
+# words, so a reader never sees one half written
+class RecordRing:
+
+    def __init__(self, shm, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.slots = shm.buf[:HEADER_SLOTS * 8].cast('Q')
+        self.float_slots = shm.buf[:HEADER_SLOTS * 8].cast('d')
+        self.data = shm.buf[HEADER_SLOTS * 8:HEADER_SLOTS * 8 + capacity * RECORD.size]
+
+    # Writes the records, waits for room in the ring while it is full. The arrival time isn't
+    # kept, the parent takes the records at their arrival time, see FrySkyParserProcess.take()
+    def push(self, records, arrival_time=None):
+        pack = RECORD.pack
+        data = bytearray()
+        for par_name, par_val in records:
+            if par_val.__class__ is tuple:
+                data += pack(par_nums[par_name], PAIR_VAL, par_val[0], par_val[1])
+            elif par_val.__class__ is int:
+                data += pack(par_nums[par_name], INT_VAL, par_val, 0.0)
+            else:
+                data += pack(par_nums[par_name], FLOAT_VAL, par_val, 0.0)
+        slots = self.slots
+        records_num = len(records)
+        done = 0
+        while done < records_num:
+            write_pos = slots[WRITE_POS]
+            free = self.capacity - (write_pos - slots[READ_POS])
+            if not free:
+                if slots[TERM]:
+                    return
+                time.sleep(RING_FULL_WAIT)
+                continue
+            n = min(free, records_num - done, self.capacity - write_pos % self.capacity)
+            start = write_pos % self.capacity * RECORD.size
+            self.data[start:start + n * RECORD.size] = data[done * RECORD.size:(done + n) * RECORD.size]
+            done += n
+            slots[WRITE_POS] = write_pos + n  # the records are seen by the reader after they are written
+
+    # Returns all records written since the previous call
+    def take(self):
+        slots = self.slots
+        read_pos = slots[READ_POS]
+        records_num = slots[WRITE_POS] - read_pos
+        if not records_num:
+            return []
+        start = read_pos % self.capacity
+        first_num = min(records_num, self.capacity - start)
+        data = bytes(self.data[start * RECORD.size:(start + first_num) * RECORD.size])
+        if first_num < records_num:
+            data += self.data[:(records_num - first_num) * RECORD.size]
+        slots[READ_POS] = read_pos + records_num
+        par_names = PAR_NAMES
+        return [(par_names[par_num], (val, val_2) if kind == PAIR_VAL else int(val) if kind == INT_VAL else val)
+                for par_num, kind, val, val_2 in RECORD.iter_unpack(data)]
+
+    # Called by the child
+    def publish(self, parser):
+        slots, float_slots = self.slots, self.float_slots
+        decoder, decode_time = parser.decoder, parser.decode_time
+        slots[CHUNKS] = parser.chunks_cntr
+        slots[BYTES] = decoder.bytes_cntr
+        slots[FRAMES] = decoder.frames_cntr
+        slots[DROPPED_FRAMES] = decoder.dropped_frames_cntr
+        slots[UNKNOWN_HUB_IDS] = decoder.unknown_hub_ids_cntr
+        slots[DECODE_COUNT] = decode_time.count
+        float_slots[DECODE_SUM] = decode_time.sum
+        float_slots[DECODE_MAX] = decode_time.max
+        slots[DECODE_BUCKETS:HEADER_SLOTS] = array('Q', decode_time.buckets)
+
+    # Called by the parent
+    def read_histogram(self, histogram):
+        histogram.buckets = self.slots[DECODE_BUCKETS:HEADER_SLOTS].tolist()
+        histogram.count = self.slots[DECODE_COUNT]
+        histogram.sum = self.float_slots[DECODE_SUM]
+        histogram.max = self.float_slots[DECODE_MAX]
+
+    def release(self):
+        self.slots.release()
+        self.float_slots.release()
+        self.data.release()
+
+
+# Parser of the child, decoded records go to the ring
+class RingParserThread(FrySkyParserThread):
+
+    def __init__(self, input_stream, ring, recorder=None):
+        FrySkyParserThread.__init__(self, input_stream, recorder)
+        self.params = ring
+
+
+def run_decoder_process(shm_name, port_name, baudrate, record_file_name):
+    shm = SharedMemory(shm_name)
+    ring = RecordRing(shm)
+    recorder = None
+    try:
+        try:
+            port = serial.Serial(port_name, baudrate, timeout=SERIAL_READ_TIMEOUT)
+        except serial.SerialException:
+            ring.slots[STATE] = PORT_FAILED
+            return
+        if record_file_name:
+            try:
+                recorder = FrySkyRecorder(record_file_name)
+            except OSError:
+                ring.slots[STATE] = RECORD_FAILED
+                port.close()
+                return
+            recorder.start()
+        parser = RingParserThread(port, ring, recorder)
+        parser.start()
+        ring.slots[STATE] = RUNNING
+        while not ring.slots[TERM] and parser.is_alive():
+            time.sleep(PUBLISH_PER)
+            parser.pause_s = ring.float_slots[PAUSE]
+            ring.publish(parser)
+        parser.term_sig = True
+        parser.join()
+        ring.publish(parser)
+        port.close()
+        if recorder:
+            recorder.term_sig = True
+            recorder.join()  # the rest of the record is written
+    finally:
+        ring.release()
+        shm.close()
+
+
+# Same interface as FrySkyParserThread: params, set_pause(), term_sig and join(). Opens the
+# port in the child, wait_ready() tells whether it has been opened
+class FrySkyParserProcess(threading.Thread):
+
+    def __init__(self, port_name, baudrate, record_file_name=None, metrics=None):
+        threading.Thread.__init__(self)
+        self.params = ParamsBuffer()
+        self.term_sig = False
+        self.shm = SharedMemory(create=True, size=ring_size())
+        self.ring = RecordRing(self.shm)
+        self.process = Process(target=run_decoder_process,
+                               args=(self.shm.name, port_name, baudrate, record_file_name), daemon=True)
+        self.state = STARTING  # of the child
+        self.counters = dict.fromkeys((name for name, slot in PUBLISHED_COUNTERS), 0)  # as the child published them
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        for name in self.counters:
+            self.metrics.counter(name, lambda name=name: self.counters[name])
+        self.metrics.counter('params.dropped', self.params.total_drops)
+        self.metrics.gauge('params.depth', self.params.depth)
+        self.decode_time = self.metrics.histogram('parser.decode_time')
+
+    def set_pause(self, new_val_ms):
+        self.ring.float_slots[PAUSE] = new_val_ms * 1e-3
+
+    def start(self):
+        self.process.start()
+        threading.Thread.start(self)
+
+    # Waits for the child to open the port. Returns its state: RUNNING or what has failed
+    def wait_ready(self, timeout=PROCESS_START_TIMEOUT):
+        wait_end = time.monotonic() + timeout
+        while self.state == STARTING and self.is_alive() and time.monotonic() < wait_end:
+            time.sleep(RING_POLL_PER)
+        return self.state
+
+    # Records are pushed at the time they are taken, at most RING_POLL_PER after they arrived
+    def take(self):
+        self.state = self.ring.slots[STATE]
+        self.params.push(self.ring.take(), time.monotonic())
+        self.counters.update((name, self.ring.slots[slot]) for name, slot in PUBLISHED_COUNTERS)
+        self.ring.read_histogram(self.decode_time)
+
+    def run(self):
+        while not self.term_sig and self.process.is_alive():
+            self.take()
+            time.sleep(RING_POLL_PER)
+        self.ring.slots[TERM] = 1
+        self.process.join()
+        self.take()
+        self.ring.release()
+        self.shm.close()
+        self.shm.unlink()
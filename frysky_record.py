@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from array import array
+from collections import deque
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+RECORD_FILE_EXT = '.fsr'
+RECORD_MAGIC = b'FSKYREC1'
+RECORD_HEADER = struct.Struct('<8sd')  # magic, wall clock time of the record start
+CHUNK_HEADER = struct.Struct('<BIII')  # flags, number of reads, data size, stored data size
+CHUNK_COMPRESSED = 0x01  # Chunk flag: data is zlib compressed
+RECORD_CHUNK_SIZE = 1 << 16  # Bytes of data collected into one chunk at most
+RECORD_FLUSH_PER = 0.5  # Period of writing collected data to the disk, seconds
+RECORD_COMPRESS_LEVEL = 1
+
+# A record is the header followed by chunks. A chunk is the chunk header, arrival times of
+# the reads (seconds since the record start, doubles), sizes of the reads (uint32) and the
+# data of all the reads, compressed as a whole if the chunk flag is set. Little endian
+
+
+# Writes data read from a serial port to a record file. The parser thread only queues the
+# data, the recorder thread collects it into chunks and writes them once per RECORD_FLUSH_PER
+class FrySkyRecorder(threading.Thread):
+
+    def __init__(self, record_file_name, compress=True):
+        threading.Thread.__init__(self)
+        self.record_file = open(record_file_name, 'wb')
+        self.compress = compress
+        self.pending = deque()
+        self.term_sig = False
+        self.clock_start = time.monotonic()
+        self.record_file.write(RECORD_HEADER.pack(RECORD_MAGIC, time.time()))
+
+    # Called by the parser with the monotonic time the data arrived at, taken by the reader.
+    # Without it the data is taken as arrived now
+    def record(self, chunk, arrival_time=None):
+        if arrival_time is None:
+            arrival_time = time.monotonic()
+        self.pending.append((arrival_time - self.clock_start, chunk))
+
+    def run(self):
+        while not self.term_sig:
+            time.sleep(RECORD_FLUSH_PER)
+            self.write_pending()
+        self.write_pending()
+        self.record_file.close()
+
+    def write_pending(self):
+        while self.pending:
+            times = array('d')
+            sizes = array('I')
+            data = bytearray()
+            while self.pending and len(data) < RECORD_CHUNK_SIZE:
+                read_time, chunk = self.pending.popleft()
+                times.append(read_time)
+                sizes.append(len(chunk))
+                data += chunk
+            self.write_chunk(times, sizes, data)
+        self.record_file.flush()
+
+    def write_chunk(self, times, sizes, data):
+        flags = 0
+        stored_data = data
+        if self.compress:
+            flags |= CHUNK_COMPRESSED
+            stored_data = zlib.compress(data, RECORD_COMPRESS_LEVEL)
+        if sys.byteorder != 'little':
+            times.byteswap()
+            sizes.byteswap()
+        self.record_file.write(CHUNK_HEADER.pack(flags, len(times), len(data), len(stored_data)))
+        self.record_file.write(times.tobytes())
+        self.record_file.write(sizes.tobytes())
+        self.record_file.write(stored_data)
+
+
+def is_record_file(record_file):
+    magic = record_file.read(len(RECORD_MAGIC))
+    record_file.seek(0)
+    return magic == RECORD_MAGIC
+
+
+# Reads a record back read by read. A chunk cut short (e.g. the recording was killed) ends
+# the record
+class RecordReader:
+
+    def __init__(self, record_file):
+        self.record_file = record_file
+        magic, self.start_time = RECORD_HEADER.unpack(record_file.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC:
+            raise ValueError('Not a FrySky record')
+        self.rewind()
+
+    def rewind(self):
+        self.record_file.seek(RECORD_HEADER.size)
+        self.times = array('d')
+        self.sizes = array('I')
+        self.data = b''
+        self.read_no = 0
+        self.data_pos = 0
+        self.last_time = 0.0  # Arrival time of the last read passed
+
+    # Loads the next chunk, chunks with all reads arrived before skip_before are skipped
+    # without unpacking. Returns False at the end of the record
+    def load_chunk(self, skip_before=None):
+        while True:
+            header = self.record_file.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return False
+            flags, reads_num, data_size, stored_size = CHUNK_HEADER.unpack(header)
+            times_bytes = self.record_file.read(8 * reads_num)
+            if len(times_bytes) < 8 * reads_num:
+                return False
+            times = array('d', times_bytes)
+            if sys.byteorder != 'little':
+                times.byteswap()
+            if skip_before is not None and times[-1] < skip_before:
+                self.record_file.seek(4 * reads_num + stored_size, os.SEEK_CUR)
+                self.last_time = times[-1]
+                continue
+            sizes_bytes = self.record_file.read(4 * reads_num)
+            data = self.record_file.read(stored_size)
+            if len(sizes_bytes) < 4 * reads_num or len(data) < stored_size:
+                return False
+            sizes = array('I', sizes_bytes)
+            if sys.byteorder != 'little':
+                sizes.byteswap()
+            if flags & CHUNK_COMPRESSED:
+                data = zlib.decompress(data)
+            self.times, self.sizes, self.data = times, sizes, data
+            self.read_no = 0
+            self.data_pos = 0
+            return True
+
+    # Returns arrival time of the next read or None at the end of the record
+    def next_time(self):
+        if self.read_no == len(self.times) and not self.load_chunk():
+            return None
+        return self.times[self.read_no]
+
+    # Returns data of the next read or None at the end of the record
+    def read_next(self):
+        read_time = self.next_time()
+        if read_time is None:
+            return None
+        size = self.sizes[self.read_no]
+        chunk = self.data[self.data_pos:self.data_pos + size]
+        self.read_no += 1
+        self.data_pos += size
+        self.last_time = read_time
+        return chunk
+
+    # Skips whole chunks arrived before the time
+    def skip_chunks(self, skip_before):
+        if self.read_no < len(self.times) and self.times[-1] >= skip_before:
+            return
+        self.read_no = len(self.times)
+        self.load_chunk(skip_before)
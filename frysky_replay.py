@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import threading
+import time
+from frysky_derived import DerivedParams
+from frysky_parser import FrySkyDecoder, FrySkyParserThread, PacketClock
+from frysky_index import get_index
+from frysky_record import RecordReader
+
+REPLAY_TICK = 0.02  # Period of catching up with the replay clock, seconds
+REPLAY_FEED_SIZE = 64  # Bytes fed at once while catching up with the replay clock
+REPLAY_FAST_FEED_SIZE = 1 << 16  # Bytes fed at once when replaying as fast as possible
+REPLAY_SPEEDS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, None)  # None: as fast as possible
+
+
+# Replays a dump file at its dump time, that is DUMP_PACKET_RATE telemetry packets per
+# second, scaled by speed. Instead of sleeping after every packet the thread wakes up once
+# per REPLAY_TICK and decodes everything due by the monotonic clock
+class FrySkyReplayThread(FrySkyParserThread):
+
+    def __init__(self, dump_file, speed=1.0, metrics=None):
+        FrySkyParserThread.__init__(self, dump_file, metrics=metrics)
+        self.speed = speed
+        self.paused = False
+        self.dump_clock = self.derived.clock  # Its time is the dump time of the data decoded so far
+        self.seek_time = None
+        self.ctrl_lock = threading.Lock()
+        self.ctrl_event = threading.Event()
+        self.clock_start = None  # (monotonic time, dump time) the replay clock counts from
+        self.index = None  # Packet index of the dump, loaded or built on the first seek
+        self.read_buf = memoryview(bytearray(max(REPLAY_FEED_SIZE, REPLAY_FAST_FEED_SIZE)))
+
+    def set_speed(self, speed):
+        with self.ctrl_lock:
+            self.speed = speed
+            self.clock_start = None
+        self.ctrl_event.set()
+
+    def set_paused(self, paused):
+        with self.ctrl_lock:
+            self.paused = paused
+            self.clock_start = None
+        self.ctrl_event.set()
+
+    def seek(self, dump_time):
+        with self.ctrl_lock:
+            self.seek_time = max(dump_time, 0.0)
+            self.clock_start = None
+        self.ctrl_event.set()
+
+    # One step of the replay, also run by a worker pool, see frysky_link. Returns the delay
+    # before the next step, seconds
+    def poll(self):
+        self.ctrl_event.clear()  # a control change from now on ends the step early
+        with self.ctrl_lock:
+            seek_time, self.seek_time = self.seek_time, None
+            paused = self.paused
+            speed = self.speed
+            if self.clock_start is None:
+                self.clock_start = (time.monotonic(), self.dump_clock.time)
+            clock_start = self.clock_start
+
+        if seek_time is not None:
+            self.skip_to(seek_time)
+            with self.ctrl_lock:
+                self.clock_start = None
+            return 0.0
+
+        if paused:
+            return REPLAY_TICK
+        if speed is None:
+            return 0.0 if self.replay_chunk(REPLAY_FAST_FEED_SIZE) else REPLAY_TICK
+        due_time = clock_start[1] + (time.monotonic() - clock_start[0]) * speed
+        while self.dump_clock.time < due_time and not self.term_sig and not self.ctrl_event.is_set():
+            if not self.replay_chunk(REPLAY_FEED_SIZE):
+                break
+        return REPLAY_TICK
+
+    def run(self):
+        while not self.term_sig:
+            delay = self.poll()
+            if delay:
+                self.wait_ctrl(delay)
+
+    # Waits for the timeout or a control change, whichever comes first
+    def wait_ctrl(self, timeout):
+        self.ctrl_event.wait(timeout)
+        self.ctrl_event.clear()
+
+    # Reads next chunk of the dump into the read buffer. Returns a view of it, empty at the end of the dump
+    def read_dump(self, size):
+        return self.read_buf[:self.input_stream.readinto(self.read_buf[:size])]
+
+    # Decodes next chunk of the dump and publishes it. Returns False at the end of the dump
+    def replay_chunk(self, size):
+        chunk = self.read_dump(size)
+        if not chunk:
+            self.flush_decoder()
+            return False
+        decode_start = time.perf_counter()
+        self.publish(self.decoder.feed(chunk))  # the derived parameters move the dump clock on
+        self.decode_time.observe(time.perf_counter() - decode_start)
+        return True
+
+    # Moves to the dump time, data before it is decoded but not published. The decoding
+    # starts from the nearest preceding packet found in the dump index, and so do the
+    # derived parameters if the decoding starts anew
+    def skip_to(self, dump_time):
+        if self.index is None:
+            self.index = get_index(self.input_stream.name)
+        offset, pack_time = self.index.find(dump_time)
+        if dump_time < self.dump_clock.time or pack_time > self.dump_clock.time:
+            self.input_stream.seek(offset)
+            self.decoder = FrySkyDecoder()
+            self.dump_clock = PacketClock(start_time=pack_time)
+            self.derived = DerivedParams(self.dump_clock)
+        while self.dump_clock.time < dump_time:
+            chunk = self.read_dump(REPLAY_FEED_SIZE)
+            if not chunk:
+                self.derived.feed(self.decoder.flush())
+                break
+            self.derived.feed(self.decoder.feed(chunk))
+        # Values from before the seek aren't shown
+        self.params.take_latest()
+        self.params.take_coors()
+        if self.params.history is not None:
+            self.params.history.clear(self.dump_clock.time)
+
+
+# Replays a record of a live session at the arrival times of the reads, which are its
+# dump time. Seeks skip whole chunks of the record without unpacking them
+class FrySkyRecordReplayThread(FrySkyReplayThread):
+
+    def __init__(self, record_file, speed=1.0, metrics=None):
+        FrySkyReplayThread.__init__(self, record_file, speed, metrics)
+        self.reader = RecordReader(record_file)
+        self.dump_clock.time = self.reader.next_time() or 0.0  # Arrival time of the next read
+
+    # Decodes the next read of the record and publishes it at its arrival time. Returns False
+    # at the end of the record
+    def replay_chunk(self, size):
+        read_time = self.reader.next_time()
+        chunk = self.reader.read_next()
+        if chunk is None:
+            self.flush_decoder(self.reader.last_time)
+            return False
+        decode_start = time.perf_counter()
+        self.publish(self.decoder.feed(chunk), read_time)
+        self.decode_time.observe(time.perf_counter() - decode_start)
+        next_time = self.reader.next_time()
+        self.dump_clock.time = next_time if next_time is not None else self.reader.last_time
+        return True
+
+    def skip_to(self, dump_time):
+        if dump_time < self.dump_clock.time:
+            self.reader.rewind()
+        self.reader.skip_chunks(dump_time)
+        self.decoder = FrySkyDecoder()
+        self.dump_clock = PacketClock()
+        self.derived = DerivedParams(self.dump_clock)
+        next_time = self.reader.next_time()
+        while next_time is not None and next_time < dump_time:
+            self.derived.feed(self.decoder.feed(self.reader.read_next()), next_time)
+            next_time = self.reader.next_time()
+        self.dump_clock.time = next_time if next_time is not None else self.reader.last_time
+        # Values from before the seek aren't shown
+        self.params.take_latest()
+        self.params.take_coors()
+        if self.params.history is not None:
+            self.params.history.clear(self.dump_clock.time)
@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 # coding=UTF-8
 
-import gpxpy
-import gpxpy.gpx
-from random import random
-from math import floor
+from array import array
+from xml.etree import ElementTree
+import argparse
+import hashlib
+import os
+import numpy as np
 
 GPS_TRACK_FILENAME = 'gps_sample.gpx'
+GPS_CACHE_DIR = '.gps_cache'  # Tracks read from GPX files, by hashes of the files
+GPX_READ_SIZE = 1 << 20
 
 LONG_MIN = 53.2294 - 0.0018
 LONG_MAX = 53.2294 + 0.0018
@@ -16,6 +20,8 @@ LAT_MAX = 50.2028 + 0.0018
 T_OVERALL = 300  # dump length, seconds
 OUT_DATA_RATE = 100
 OUT_FILENAME = 'dump.bin'
+SIM_CHUNK_PACKETS = 1 << 16  # Packet times generated at once
+PACK_LEN = 11  # Length of an unstuffed packet
 
 sig_lev_pnts = [
     (0.0, 89),
@@ -59,157 +65,160 @@ params = (
 )
 
 
-def gen_frysky_dump():
-    gps_coor = transform_gps_track(LONG_MIN, LONG_MAX, LAT_MIN, LAT_MAX)
-    with open(OUT_FILENAME, 'bw') as out_dump_file:
-        for packet_no in range(T_OVERALL * OUT_DATA_RATE):
-            for par in params:
-                points = par['points']
-                t = packet_no / OUT_DATA_RATE
-                for point_no in range(len(points) - 1):
-                    t_left = points[point_no][0]
-                    t_right = points[point_no + 1][0]
-                    if t_left <= t <= t_right:
-                        val_left = points[point_no][1]
-                        val_right = points[point_no + 1][1]
-                        val = ((val_right - val_left) / (t_right - t_left)) * (t - t_left) + val_left
-                        val += val * par['noise_std'] * (random() - 0.5)
-                        par['cur_val'] = val
-                        # print(par['name'], par['cur_val'])
-            # General telemetry packet
-            packet = \
-                b'\x7E\xFE' + \
-                (round(list(filter(lambda x: x['name'] == 'vlt', params))[0]['cur_val'])).to_bytes(1, byteorder='big') + \
-                (round(list(filter(lambda x: x['name'] == 'cur', params))[0]['cur_val'])).to_bytes(1, byteorder='big') + \
-                (round(list(filter(lambda x: x['name'] == 'sig_lev', params))[0]['cur_val'])).to_bytes(1, byteorder='big') + \
-                b'\x00\x00\x00\x00\x00' + \
-                b'\x7E'
-            out_dump_file.write(packet_proc(packet, 'tel'))
-            # Rotation frequency packet
-            packet = \
-                b'\x5E\x03' + \
-                (round(list(filter(lambda x: x['name'] == 'rot_freq', params))[0]['cur_val'])).to_bytes(2, byteorder='little') + \
-                b'\x00\x00\x00\x00\x00\x00' + \
-                b'\x5E'
-            out_dump_file.write(packet_proc(packet, 'hub'))
-            # GPS info
-            if packet_no % 100 == 0:
-                gps_pnt_no = packet_no // 100
-                if gps_pnt_no < len(gps_coor):
-                    gps_pnt = gps_coor[gps_pnt_no]
-                    deg_long = floor(gps_pnt[0])
-                    min_long = (gps_pnt[0] - deg_long) * 60.0
-                    deg_lat = floor(gps_pnt[1])
-                    min_lat = (gps_pnt[1] - deg_lat) * 60.0
-                    before_point_long = deg_long * 100 + floor(min_long)
-                    after_point_long = round((min_long - floor(min_long)) * 10000)
-                    before_point_lat= deg_lat * 100 + floor(min_lat)
-                    after_point_lat = round((min_lat - floor(min_lat)) * 10000)
-                    packet = \
-                        b'\x5E\x12' + \
-                        before_point_long.to_bytes(2, byteorder='little') + \
-                        b'\x00\x00\x00\x00\x00\x00' + \
-                        b'\x5E'
-                    out_dump_file.write(packet_proc(packet, 'hub'))
-                    packet = \
-                        b'\x5E\x1A' + \
-                        after_point_long.to_bytes(2, byteorder='little') + \
-                        b'\x00\x00\x00\x00\x00\x00' + \
-                        b'\x5E'
-                    out_dump_file.write(packet_proc(packet, 'hub'))
-                    packet = \
-                        b'\x5E\x13' + \
-                        before_point_lat.to_bytes(2, byteorder='little') + \
-                        b'\x00\x00\x00\x00\x00\x00' + \
-                        b'\x5E'
-                    out_dump_file.write(packet_proc(packet, 'hub'))
-                    packet = \
-                        b'\x5E\x1B' + \
-                        after_point_lat.to_bytes(2, byteorder='little') + \
-                        b'\x00\x00\x00\x00\x00\x00' + \
-                        b'\x5E'
-                    out_dump_file.write(packet_proc(packet, 'hub'))
-
-
-def transform_gps_track(long_min, long_max, lat_min, lat_max):
-    gpx_file = open(GPS_TRACK_FILENAME, 'r')
-    gpx = gpxpy.parse(gpx_file)
-    
-    track_long_min = 361.0
-    track_long_max = -1.0
-    track_lat_min = 361.0
-    track_lat_max = -1.0
-
-    # search min and max
-    points_cntr = 0
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                long = point.longitude
-                lat = point.latitude
-                if long < track_long_min:
-                    track_long_min = long
-                elif long > track_long_max:
-                    track_long_max = long
-                if lat < track_lat_min:
-                    track_lat_min = lat
-                elif lat > track_lat_max:
-                    track_lat_max = lat
-                points_cntr += 1
-        break
-
-    # calc scale coefficients
-    long_scale = (long_max - long_min) / (track_long_max - track_long_min)
-    lat_scale = (lat_max - lat_min) / (track_lat_max - track_lat_min)
-    time_decimation = points_cntr // T_OVERALL
-
-    # rescale and decimate
-    gps_coor = []
-    points_cntr = 0
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                points_cntr += 1
-                if points_cntr % time_decimation == 0:
-                    long = point.longitude
-                    lat = point.latitude
-                    delta_long = long - track_long_min
-                    delta_lat = lat - track_lat_min
-                    new_long = long_min + delta_long * long_scale
-                    new_lat = lat_min + delta_lat * lat_scale
-                    gps_coor.append((new_long, new_lat))
-        break
-
-    return gps_coor
-
-def packet_proc(packet, device):
-    i = 2
-    pack_len = len(packet)
-    if device == 'tel':
-        while i < pack_len - 1:
-            if packet[i] == 0x7E:
-                packet = packet[:i] + b'\x7D\x5E' + packet[i+1:]
-                i += 2
-                pack_len += 1
-            if packet[i] == 0x5D:
-                packet = packet[:i] + b'\x7D\x5D' + packet[i+1:]
-                i += 2
-                pack_len += 1
-            i += 1
-    elif device == 'hub':
-        while i < pack_len - 1:
-            if packet[i] == 0x5E:
-                packet = packet[:i] + b'\x5D\x3E' + packet[i+1:]
-                i += 2
-                pack_len += 1
-            if packet[i] == 0x5D:
-                packet = packet[:i] + b'\x5D\x3D' + packet[i+1:]
-                i += 2
-                pack_len += 1
-            i += 1
-    return packet
+# Values of the parameter at the times given. Segments are evaluated in the order of the
+# points, a later segment wins where segments overlap
+def gen_series(par, t, rng):
+    points = par['points']
+    vals = np.zeros(len(t))
+    for (t_left, val_left), (t_right, val_right) in zip(points, points[1:]):
+        in_segment = (t_left <= t) & (t <= t_right)
+        vals[in_segment] = ((val_right - val_left) / (t_right - t_left)) * (t[in_segment] - t_left) + val_left
+    vals += vals * par['noise_std'] * (rng.random(len(t)) - 0.5)
+    return vals
+
+
+def tel_packets(vlt, cur, sig_lev):
+    packets = np.zeros((len(vlt), PACK_LEN), np.uint8)
+    packets[:, 0] = packets[:, -1] = 0x7E
+    packets[:, 1] = 0xFE
+    packets[:, 2] = np.clip(np.rint(vlt), 0, 0xFF)
+    packets[:, 3] = np.clip(np.rint(cur), 0, 0xFF)
+    packets[:, 4] = np.clip(np.rint(sig_lev), 0, 0xFF)
+    return packets
+
+
+def hub_packets(prim, vals):
+    vals = np.clip(np.rint(vals), 0, 0xFFFF).astype(np.int64)
+    packets = np.zeros((len(vals), PACK_LEN), np.uint8)
+    packets[:, 0] = packets[:, -1] = 0x5E
+    packets[:, 1] = prim
+    packets[:, 2] = vals & 0xFF
+    packets[:, 3] = vals >> 8
+    return packets
+
+
+# GPS packets of every track point: longitude and latitude before and after the point
+def gps_packets(gps_coor):
+    coor = np.array(gps_coor, dtype=float).reshape(-1, 2)
+    deg = np.floor(coor)
+    minutes = (coor - deg) * 60.0
+    before_point = deg * 100 + np.floor(minutes)
+    after_point = np.rint((minutes - np.floor(minutes)) * 10000)
+    return np.stack((hub_packets(0x12, before_point[:, 0]),
+                     hub_packets(0x1A, after_point[:, 0]),
+                     hub_packets(0x13, before_point[:, 1]),
+                     hub_packets(0x1B, after_point[:, 1])), axis=1)
+
+
+# Byte stuffing of the payload of all packets at once. Packets are rows, is_tel marks
+# telemetry ones, the rest are hub ones
+def stuff_packets(packets, is_tel):
+    is_tel = np.broadcast_to(is_tel[:, None], packets.shape)
+    in_payload = np.zeros(packets.shape, bool)
+    in_payload[:, 2:-1] = True
+    to_escape = in_payload & np.where(is_tel, (packets == 0x7E) | (packets == 0x7D),
+                                      (packets == 0x5E) | (packets == 0x5D))
+    flat = packets.ravel()
+    to_escape = to_escape.ravel()
+    is_tel = is_tel.ravel()[to_escape]
+    # escaped bytes take two bytes: the escape byte and the byte XORed
+    lens = 1 + to_escape
+    stuffed = np.repeat(flat, lens)
+    escape_pos = (np.cumsum(lens) - lens)[to_escape]
+    stuffed[escape_pos] = np.where(is_tel, 0x7D, 0x5D)
+    stuffed[escape_pos + 1] = flat[to_escape] ^ np.where(is_tel, 0x20, 0x60)
+    return stuffed.tobytes()
+
+
+# Every packet time there are a telemetry packet and a rotation frequency packet, once a
+# second there are GPS packets of the next track point. The flight profile is stretched to
+# the duration. Yields stuffed packets of SIM_CHUNK_PACKETS packet times at once
+def gen_frysky_chunks(duration=T_OVERALL, rate=OUT_DATA_RATE, seed=None):
+    rng = np.random.default_rng(seed)
+    gps = gps_packets(transform_gps_track(LONG_MIN, LONG_MAX, LAT_MIN, LAT_MAX, duration))
+    packets_num = round(duration * rate)
+    for chunk_start in range(0, packets_num, SIM_CHUNK_PACKETS):
+        packet_no = np.arange(chunk_start, min(chunk_start + SIM_CHUNK_PACKETS, packets_num))
+        t = packet_no / rate * (T_OVERALL / duration)
+        vals = {par['name']: gen_series(par, t, rng) for par in params}
+
+        has_gps = (packet_no % rate == 0) & (packet_no // rate < len(gps))
+        rows_nums = 2 + 4 * has_gps
+        first_rows = np.cumsum(rows_nums) - rows_nums
+        packets = np.empty((rows_nums.sum(), PACK_LEN), np.uint8)
+        packets[first_rows] = tel_packets(vals['vlt'], vals['cur'], vals['sig_lev'])
+        packets[first_rows + 1] = hub_packets(0x03, vals['rot_freq'])
+        packets[first_rows[has_gps][:, None] + np.arange(2, 6)] = gps[packet_no[has_gps] // rate]
+        is_tel = np.zeros(len(packets), bool)
+        is_tel[first_rows] = True
+        yield stuff_packets(packets, is_tel)
+
+
+def gen_frysky_dump(out_filename=OUT_FILENAME, duration=T_OVERALL, rate=OUT_DATA_RATE, seed=None):
+    with open(out_filename, 'bw') as out_dump_file:
+        for chunk in gen_frysky_chunks(duration, rate, seed):
+            out_dump_file.write(chunk)
+
+
+def file_hash(file_name):
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(GPX_READ_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Reads points of the first track of a GPX file in one pass, points already read are
+# dropped from the XML tree. Returns array of (longitude, latitude)
+def parse_gpx_track(file_name):
+    coor = array('d')
+    segment = None
+    for event, elem in ElementTree.iterparse(file_name, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag == 'trkseg':
+                segment = elem
+        elif tag == 'trkpt':
+            coor.append(float(elem.get('lon')))
+            coor.append(float(elem.get('lat')))
+            if segment is not None:
+                segment.clear()
+        elif tag == 'trk':
+            break
+    return np.frombuffer(coor).reshape(-1, 2)
+
+
+# Points of the first track of a GPX file, cached by the file hash
+def load_gps_track(file_name=GPS_TRACK_FILENAME):
+    cache_file_name = os.path.join(GPS_CACHE_DIR, file_hash(file_name) + '.npy')
+    try:
+        return np.load(cache_file_name)
+    except (OSError, ValueError):
+        pass
+    coor = parse_gpx_track(file_name)
+    try:
+        os.makedirs(GPS_CACHE_DIR, exist_ok=True)
+        np.save(cache_file_name, coor)
+    except OSError:
+        pass  # the track is loaded again next time
+    return coor
+
+
+# Fits the track into the box and leaves about one point per second of the duration
+def transform_gps_track(long_min, long_max, lat_min, lat_max, duration=T_OVERALL):
+    coor = load_gps_track(GPS_TRACK_FILENAME)
+    track_min = coor.min(axis=0)
+    track_max = coor.max(axis=0)
+    scale = (np.array((long_max, lat_max)) - (long_min, lat_min)) / (track_max - track_min)
+    time_decimation = max(int(len(coor) // duration), 1)
+    return (long_min, lat_min) + (coor[time_decimation - 1::time_decimation] - track_min) * scale
 
 
 if __name__ == '__main__':
-    gen_frysky_dump()
-    # transform_gps_track(0,0,0,0)
+    arg_parser = argparse.ArgumentParser(description='Generates a FrySky dump file')
+    arg_parser.add_argument('-d', '--duration', type=float, default=T_OVERALL, help='dump length, seconds')
+    arg_parser.add_argument('-r', '--rate', type=int, default=OUT_DATA_RATE, help='telemetry packets per second')
+    arg_parser.add_argument('-s', '--seed', type=int, help='random generator seed')
+    arg_parser.add_argument('-o', '--output', default=OUT_FILENAME, help='dump file name')
+    args = arg_parser.parse_args()
+    gen_frysky_dump(args.output, args.duration, args.rate, args.seed)
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import numpy as np
+
+TRACK_TAG = 'track'
+TRACK_COLOR = '#ee1111'
+TRACK_WIDTH = 2
+TRACK_LINE_LEN = 256  # Points in one polyline item, new points only touch the last item
+LOD_TOLERANCE_PX = 0.5  # Largest deviation of the drawn track from the actual one, pixels
+TRACK_STORE_CAPACITY = 4096  # Coordinates the track store has room for initially
+DECIMATE_SCALAR_MAX = 48  # Points of a segment searched without NumPy, it costs more for a few points
+
+
+# Coordinates of the track as rows of a growable array: longitude, latitude
+class TrackStore:
+
+    def __init__(self, capacity=TRACK_STORE_CAPACITY):
+        self.coors = np.empty((capacity, 2))
+        self.coors_num = 0
+
+    def __len__(self):
+        return self.coors_num
+
+    # Appends the coordinates, returns them as rows of the store
+    def extend(self, coors):
+        new_num = self.coors_num + len(coors)
+        if new_num > len(self.coors):
+            grown = np.empty((max(2 * len(self.coors), new_num), 2))
+            grown[:self.coors_num] = self.coors[:self.coors_num]
+            self.coors = grown
+        self.coors[self.coors_num:new_num] = coors
+        self.coors_num, first = new_num, self.coors_num
+        return self.coors[first:new_num]
+
+    def view(self):
+        return self.coors[:self.coors_num]
+
+
+# Point of the segment farthest from the line through its ends: (squared distance, index)
+def farthest_point(points, rows, first, last):
+    x1, y1 = rows[first]
+    dx, dy = rows[last][0] - x1, rows[last][1] - y1
+    seg_len_sq = dx * dx + dy * dy
+    if last - first > DECIMATE_SCALAR_MAX:
+        inner = points[first + 1:last] - points[first]
+        if seg_len_sq:
+            dist_sq = (inner[:, 0] * dy - inner[:, 1] * dx) ** 2 / seg_len_sq
+        else:
+            dist_sq = inner[:, 0] * inner[:, 0] + inner[:, 1] * inner[:, 1]
+        max_idx = int(dist_sq.argmax())
+        return dist_sq[max_idx], max_idx + first + 1
+    max_dist_sq, max_idx = 0.0, 0
+    for i in range(first + 1, last):
+        px, py = rows[i][0] - x1, rows[i][1] - y1
+        if seg_len_sq:
+            # squared distance to the line through the segment ends
+            dist_sq = (px * dy - py * dx) ** 2 / seg_len_sq
+        else:
+            dist_sq = px * px + py * py
+        if dist_sq > max_dist_sq:
+            max_dist_sq, max_idx = dist_sq, i
+    return max_dist_sq, max_idx
+
+
+# Douglas-Peucker decimation of a polyline given as rows of points
+def decimate(points, tolerance):
+    pnts_num = len(points)
+    if pnts_num < 3:
+        return points
+    rows = points.tolist()
+    keep = np.zeros(pnts_num, bool)
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, pnts_num - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        max_dist_sq, max_idx = farthest_point(points, rows, first, last)
+        if max_dist_sq > tolerance_sq:
+            keep[max_idx] = True
+            stack.append((first, max_idx))
+            stack.append((max_idx, last))
+    return points[keep]
+
+
+# Draws the track as a few polyline items. New points extend the last item, a change of
+# scale redraws the whole track decimated to the current scale. Every point is projected
+# from its coordinates, whole arrays of them at once
+class TrackRenderer:
+
+    def __init__(self, can, can_w, can_h, margin_px, color=TRACK_COLOR, tag=TRACK_TAG):
+        self.can = can
+        self.color = color
+        self.tag = tag  # Canvas items of every track on the canvas have their own tag
+        self.can_w = can_w
+        self.can_h = can_h
+        # shrink towards the canvas center to keep the track off the borders
+        self.x_shrink = (can_w - margin_px) / can_w
+        self.y_shrink = (can_h - margin_px) / can_h
+        self.long_min = 0.0
+        self.lat_min = 0.0
+        self.px_per_deg = 1.0
+        self.lines = []
+        self.tail = []  # Points of the last polyline item
+        self.leading_mark = None
+
+    # Canvas points of the coordinates, as rows
+    def project(self, coors):
+        x = (coors[:, 0] - self.long_min) * self.px_per_deg
+        y = self.can_h - (coors[:, 1] - self.lat_min) * self.px_per_deg
+        return np.column_stack(((x - self.can_w / 2) * self.x_shrink + self.can_w / 2,
+                                (y - self.can_h / 2) * self.y_shrink + self.can_h / 2))
+
+    def clear(self):
+        self.can.delete(self.tag)
+        self.lines = []
+        self.tail = []
+        self.leading_mark = None
+
+    def redraw(self, coors, long_min, lat_min, px_per_deg):
+        self.clear()
+        self.long_min = long_min
+        self.lat_min = lat_min
+        self.px_per_deg = px_per_deg
+        points = decimate(self.project(coors), LOD_TOLERANCE_PX).ravel().tolist()
+        line_len = 2 * TRACK_LINE_LEN
+        for i in range(0, max(len(points) - 2, 1), line_len - 2):
+            self.tail = points[i:i + line_len]
+            self.draw_tail(new_line=True)
+        self.draw_leading_mark()
+
+    # Extends the track with rows of coordinates
+    def add_points(self, coors):
+        points = self.project(coors).ravel().tolist()
+        new_line = not self.lines
+        while True:
+            room = 2 * TRACK_LINE_LEN - len(self.tail)
+            if room > 0:
+                self.tail += points[:room]
+                points = points[room:]
+                self.draw_tail(new_line)
+            if not points:
+                break
+            # a full item is left as it is, the next one starts from its last point
+            self.tail = self.tail[-2:]
+            new_line = True
+        self.draw_leading_mark()
+
+    def draw_tail(self, new_line):
+        if len(self.tail) < 4:
+            return
+        if new_line:
+            self.lines.append(self.can.create_line(*self.tail, width=TRACK_WIDTH, fill=self.color,
+                                                   tags=self.tag))
+        else:
+            self.can.coords(self.lines[-1], *self.tail)
+
+    def draw_leading_mark(self):
+        if len(self.tail) < 2:
+            return
+        x, y = self.tail[-2], self.tail[-1]
+        if self.leading_mark:
+            self.can.coords(self.leading_mark, x - 4, y - 4, x + 4, y + 4)
+        else:
+            self.leading_mark = self.can.create_oval(x - 4, y - 4, x + 4, y + 4, fill=self.color,
+                                                       tags=self.tag)
+        self.can.tag_raise(self.leading_mark)